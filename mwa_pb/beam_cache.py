@@ -0,0 +1,304 @@
+"""Caches used by the beam models to avoid recomputing data that only depend on their inputs.
+
+LRUCache is a thread-safe, size-bounded in-memory cache, e.g. for the gridded Jones matrices
+of the full EE model, with counters of hits and misses for introspection.
+
+DiskCache stores numpy arrays in a directory shared between processes, so that e.g. the
+accumulated spherical harmonics modes of the full EE model for a given
+(h5 file, frequency, delays, amplitudes) are only calculated once per machine
+instead of once per process. The cache is opt-in: it is only used if
+config.BEAM_CACHE_DIR (or the MWA_PB_CACHE_DIR environment variable) is set.
+
+Entries are written to a temporary file and atomically renamed into place, so concurrent
+writers (e.g. many worker processes pointing at the same sweet spot) never produce
+partially written entries. Reading an entry updates its modification time and the
+least recently used entries are removed once the total size exceeds the configured limit.
+"""
+
+import collections
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import config
+
+logging.basicConfig(format='# %(levelname)s:%(name)s: %(message)s')
+logger = logging.getLogger(__name__)  # default logger level is WARNING
+
+FILE_HASHES = {}    # Contains content hashes of files - the key is (path, size, mtime)
+
+DISK_CACHE = None   # DiskCache object for config.BEAM_CACHE_DIR, created on first use
+
+
+def atomic_replace(src, dst):
+    """Move the file src to dst (on the same file system), atomically replacing any existing dst,
+    so that readers of dst see either the old or the new file"""
+    # os.replace is atomic and overwrites on all platforms, but is not available in Python 2
+    getattr(os, 'replace', os.rename)(src, dst)
+
+
+def file_stamp(path):
+    """Return (real path, size, modification time) of a file, a cheap key for in-process
+    caches of data read from it (use file_hash for keys that persist, e.g. in the disk cache)"""
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime)
+
+
+def file_hash(path, blocksize=2 ** 20):
+    """Return the SHA1 hex digest of the content of a file.
+    The result is remembered for the lifetime of the process (and in the disk cache, if enabled)
+    as long as the size and modification time of the file do not change."""
+    stamp = file_stamp(path)
+    if stamp in FILE_HASHES:
+        return FILE_HASHES[stamp]
+
+    cache = get_disk_cache()
+    stamp_key = None
+    if cache is not None:
+        stamp_key = make_key('file_hash', *stamp)
+        entry = cache.load(stamp_key)
+        if entry is not None:
+            FILE_HASHES[stamp] = str(entry['digest'])
+            return FILE_HASHES[stamp]
+
+    logger.debug('Calculating content hash of %s' % path)
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+    FILE_HASHES[stamp] = sha.hexdigest()
+    if cache is not None:
+        cache.save(stamp_key, digest=np.array(FILE_HASHES[stamp]))
+    return FILE_HASHES[stamp]
+
+
+def make_key(*parts):
+    """Return a cache key (hex digest) for the given parts.
+    numpy arrays are hashed by dtype, shape and content, everything else by its repr"""
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            sha.update(repr((part.dtype.str, part.shape)).encode('utf-8'))
+            sha.update(part.tobytes())
+        else:
+            sha.update(repr(part).encode('utf-8'))
+        sha.update(b'|')
+    return sha.hexdigest()
+
+
+def get_nbytes(value):
+    """Return the memory used by value in bytes: the sum of nbytes of the numpy arrays
+    in value (which can also be a tuple, list or dict of arrays) or its own get_nbytes()"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (tuple, list)):
+        return sum([get_nbytes(v) for v in value])
+    elif isinstance(value, dict):
+        return sum([get_nbytes(v) for v in value.values()])
+    elif hasattr(value, 'get_nbytes'):
+        return value.get_nbytes()
+    return 0
+
+
+class LRUCache(object):
+    """Thread-safe in-memory cache, bounded in number of entries and/or bytes, evicting
+    the least recently used entries first"""
+
+    def __init__(self, max_bytes=None, max_entries=None, sizeof=get_nbytes):
+        """
+        Input:
+        max_bytes - maximum total size of the values (bytes), None for no limit
+        max_entries - maximum number of entries, None for no limit
+        sizeof - function returning the size of a value in bytes
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()    # key -> (value, size), least recently used first
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value cached under key (marking it as recently used) or default"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        """Cache value under key and evict entries until the cache is within its limits.
+        A value larger than max_bytes is not cached."""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if (self.max_bytes is not None) and (size > self.max_bytes):
+                logger.debug('Not caching value of %s bytes, larger than the cache (%s bytes)' % (size, self.max_bytes))
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while ((self.max_bytes is not None) and (self.nbytes > self.max_bytes)) or \
+                    ((self.max_entries is not None) and (len(self._entries) > self.max_entries)):
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def get_or_create(self, key, create):
+        """Return the value cached under key, or create() it and cache it if there is none.
+        The lock is not held while calling create(), so several threads may create the same value."""
+        with self._lock:
+            if key in self._entries:
+                return self.get(key)
+            self.misses += 1
+        value = create()
+        with self._lock:
+            if key in self._entries:   # created by another thread in the meantime
+                return self._entries[key][0]
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Remove all entries (the counters are not reset)"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Return a dictionary with the hits, misses, evictions, number of entries and bytes used"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes, 'max_entries': self.max_entries}
+
+
+class DiskCache(object):
+    """Size-bounded, least recently used cache of numpy arrays in a directory"""
+
+    suffix = '.npz'
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        Input:
+        cache_dir - directory holding the cache entries, created if needed
+        max_bytes - maximum total size of the entries (bytes), None for no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def load(self, key):
+        """Return a dictionary of the arrays stored under key or None if there is no such entry"""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = dict((name, entry[name]) for name in entry.files)
+            os.utime(path, None)    # mark as recently used
+        except (IOError, OSError, ValueError, EOFError) as err:
+            # missing, evicted by another process, or unreadable - treat all as a miss
+            if getattr(err, 'errno', None) != errno.ENOENT:
+                logger.debug('Unable to read cache entry %s: %s' % (path, err))
+            return None
+        logger.debug('Loaded cache entry %s' % path)
+        return arrays
+
+    def save(self, key, **arrays):
+        """Store arrays under key, replacing any existing entry, then enforce the size limit"""
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+        except OSError:
+            if not os.path.isdir(self.cache_dir):   # someone else may have just created it
+                logger.warning('Unable to create cache directory %s' % self.cache_dir)
+                return
+
+        # write to a unique temporary file in the same directory and atomically move it into place
+        (fd, tmppath) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            atomic_replace(tmppath, self._path(key))
+        except (IOError, OSError) as err:
+            logger.warning('Unable to write cache entry %s: %s' % (self._path(key), err))
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            return
+        logger.debug('Saved cache entry %s' % self._path(key))
+        self.evict()
+
+    def entries(self):
+        """Return a list of (mtime, size, path) of the entries in the cache, oldest first"""
+        result = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return result
+        for name in names:
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:    # removed by another process
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        result.sort()
+        return result
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within max_bytes"""
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum([size for (mtime, size, path) in entries])
+        for (mtime, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                logger.debug('Evicted cache entry %s' % path)
+            except OSError:    # already removed by another process
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        for (mtime, size, path) in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_disk_cache():
+    """Return the DiskCache for config.BEAM_CACHE_DIR, or None if the disk cache is disabled"""
+    global DISK_CACHE
+    if not config.BEAM_CACHE_DIR:
+        return None
+    if (DISK_CACHE is None) or (DISK_CACHE.cache_dir != config.BEAM_CACHE_DIR):
+        DISK_CACHE = DiskCache(config.BEAM_CACHE_DIR, max_bytes=config.BEAM_CACHE_MAX_BYTES)
+    DISK_CACHE.max_bytes = config.BEAM_CACHE_MAX_BYTES
+    return DISK_CACHE
@@ -19,7 +19,21 @@ need only be done once for each theta (ZA) and each phi (az) angle.
 The calculation for each (theta,phi) point is then a simple multiplication.
 A linear interpolation from the gridded beam is required as the 
 slant orthographic projection results in many unique theta (ZA) and phi (az) points, 
-but this is also relatively fast.
+but this is also relatively fast. An InterpPlan object holds the grid indices and weights
+of the (bilinear or bicubic) interpolation for a set of coordinates, so that it can be reused
+for all the Jones terms of several beams or frequencies on the same coordinates.
+
+Where many beams (e.g. several frequencies or pointings) are required on the same
+coordinates, a DirectionBasis object holds the direction-dependent part of the calculation
+and evaluates all the beams as a batched contraction of their modes against it.
+A BeamSet accumulates the modes of many sets of delays and amplitudes at once (e.g. all the
+sweet spots) and evaluates them together in this way, and TileBeams evaluates each distinct
+configuration of the tiles of an array (e.g. with different flagged dipoles) only once.
+An IncrementalBeam keeps the contribution of each antenna on a set of coordinates, so that
+changing the delay or amplitude of one dipole only costs O(number of points).
+A HealpixBasis does the same for the pixels of a HEALPix map above the horizon, with the
+Legendre terms calculated once per iso-latitude ring and an FFT along each ring, so that
+all-sky integrals (Beam.get_solid_angle, Beam.get_tant) are sums over equal-area pixels.
 
 If this module is run stand-alone, 
 the a beam will be generated and the various outputs plotted.
@@ -32,22 +46,18 @@ Calculating Far-Field Radiation Based on FEKO
 """
 
 import datetime  # For info-level logging
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import logging
 import os
 import math
 
-# The following try/except allows older versions of scipy (<1.0.0) to work.
-try:
-    from scipy.special import factorial
-except ImportError:
-    from scipy.misc import factorial
 from scipy.special import lpmv  # associated Legendre function
 
 from astropy.io import fits
-from scipy.interpolate import RegularGridInterpolator
 
 import config
+import beam_cache
 import beam_tools
 
 logging.basicConfig(format='# %(levelname)s:%(name)s: %(message)s')
@@ -63,19 +73,35 @@ except ImportError:
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 
-AACACHE = {}    # Contains cached ApartureArray objects - the key is frequency in Hertz
+# complex data types of the evaluation of the beams for precision='double' and 'single'
+PRECISIONS = {'double': np.complex128, 'single': np.complex64}
+
+# cost of an FFT of length L relative to the dense product, per L*log2(L) and per n_phi*(2*nmax+1) respectively
+# (measured with numpy's FFT and OpenBLAS on full grids of 2-10 pixels per degree), used to choose between them
+# for gridded beams: the FFT is only chosen for high degrees, e.g. nmax > ~55 at 5 pixels per degree
+FFT_COST_FACTOR = 10.0
+
+# Contains cached ApartureArray objects - the key is (model path, freq_interp, model frequency in Hertz),
+# where the model frequency is the tabulated frequency for freq_interp='nearest' (see select_freqs)
+AACACHE = beam_cache.LRUCache(max_bytes=config.AA_CACHE_MAX_BYTES, max_entries=config.AA_CACHE_MAX_ENTRIES)
+
+# gridded Jones matrices of beams used by Beam.get_interp_response, for all ApertureArray objects -
+# the key is (model stamp, n_ant, key of the beam and the grid), see Beam.get_gridded_response
+GRID_CACHE = beam_cache.LRUCache(max_bytes=config.GRIDDED_BEAM_CACHE_MAX_BYTES)
+
+# coefficients (see load_h5_coefficients) of tabulated frequencies, shared by all ApertureArray objects -
+# the key is (beam_cache.file_stamp of the h5 file, n_ant, tabulated frequency in Hertz)
+COEFFICIENT_CACHE = beam_cache.LRUCache(max_bytes=config.COEFFICIENT_CACHE_MAX_BYTES)
+
+H5FILES = {}    # h5 files opened by get_h5file - the key is the path, the value (h5py File object, frequencies)
 
-# load default h5file on startup to save time
-if not os.path.exists(config.h5file):
-    logger.error('Cannot find beam model file %s' % config.h5file)
-    H5FILE = None
-    H5FREQS = []
-else:
-    logger.debug('Loading beam model from file %s' % config.h5file)
-    logger.debug("H5 file (%s) version = %s" % (config.h5file, config.h5fileversion))
-    H5FILE = h5py.File(config.h5file, 'r')
-    H5FREQS = np.array([int(x[3:]) for x in H5FILE.keys() if 'X1_' in x])
-    H5FREQS.sort()
+COEFFICIENT_STORES = {}    # CoefficientStore objects opened by get_coefficient_store - the key is the path
+
+# Jones matrices used for the zenith normalisation (see get_zenith_jones) - the key is (model stamp, n_ant),
+# the value a dictionary with the tabulated frequencies as keys
+ZENITH_JONES = {}
+
+LOGGED_XY_PHASE = {}    # the config.xy_phase_deg last reported by sigma_to_jones
 
 # scipy.__version__ >= '0.15.1' should be satisfied by the package setup.py file
 
@@ -85,43 +111,140 @@ class ApertureArray(object):
 
     # TODO: add some checks to h5 file. e.g. check n_ant matches number in h5 file.
     # TODO: in the beam modelling, there is still 16 antenna hardcoded. This needs fixing.
-    def __init__(self, h5filepath, target_freq_Hz, n_ant=16):
-        # freq_interp=nearest, linear
+    def __init__(self, h5filepath, target_freq_Hz, n_ant=16, freq_interp='nearest'):
         """Constructor for beamformed aperture array.
            Input:
            h5filepath - path to h5 file containing coefficients
            target_freq_Hz - frequency at which beam model is required
            n_ant - number of antennas in array/tile
+           freq_interp - 'nearest' to use the coefficients of the nearest tabulated frequency,
+                         'linear' to interpolate the coefficients linearly between the two tabulated
+                         frequencies either side of target_freq_Hz (the nearest is used outside of
+                         the tabulated range). In 'linear' mode self.freq is target_freq_Hz, which is
+                         also the frequency of the beamformer delay phases.
         """
+        if freq_interp not in ['nearest', 'linear']:
+            e = 'Frequency interpolation %s not supported' % freq_interp
+            logger.error(e)
+            raise ValueError(e)
         logger.info('New model of the physical tile, modelled using full embedded element patterns with the beam described by spherical harmonics.')
         logger.info('This new beam model is still being tested and is not an official release')
         logger.info('Code version date: 2017-07-20 (Sigma_P sign flipped standalone version)')
 
         self.n_ant = n_ant
         self.norm_fac = None
+        self.h5filepath = h5filepath
 
+        self.h5f = None
+        self.store = None
         # If the h5 file isn't there, raise an IOError
         if not os.path.exists(h5filepath):
             logger.error('Fatal error - h5 file not found at specified location: %s' % h5filepath)
             raise IOError('h5 file not found at specified location: %s' % h5filepath)
-        # If we were passed the name of the default h5 file, and it exists, use the pre-loaded copy for speed
-        elif h5filepath == config.h5file:
-            self.h5f = H5FILE
-            self.h5_file_version = config.h5fileversion
-            freqs = H5FREQS
-        # If we were passed a filename that's not the default h5 file, load it now
+        # If we were passed a directory, it is a store of coefficients compiled from an h5 file
+        elif os.path.isdir(h5filepath):
+            self.store = get_coefficient_store(h5filepath)
+            if self.store.n_ant != n_ant:
+                e = 'Coefficient store %s has %s antennas, not %s' % (h5filepath, self.store.n_ant, n_ant)
+                logger.error(e)
+                raise ValueError(e)
+            self.h5_file_version = self.store.h5_file_version
+            freqs = self.store.freqs
+        # The h5 files are opened once and shared by all ApertureArray objects
+        else:
+            (self.h5f, freqs) = get_h5file(h5filepath)
+            if h5filepath == config.h5file:
+                self.h5_file_version = config.h5fileversion
+            else:
+                self.h5_file_version = None    # Unknown, can't use the version in the config module.
+
+        self.freq_interp = freq_interp
+        (self.freq, self.freq_weights) = select_freqs(freqs, target_freq_Hz, freq_interp)
+        if len(self.freq_weights) > 1:
+            logger.info("%s MHz requested, interpolating between freqs %s MHz and %s MHz" %
+                        (target_freq_Hz / 1.e6, self.freq_weights[0][0] / 1.e6, self.freq_weights[1][0] / 1.e6))
         else:
-            logger.debug('Loading beam model from file %s' % h5filepath)
-            self.h5f = h5py.File(h5filepath, 'r')
-            self.h5_file_version = None    # Unknown, can't use the version in the config module.
-            # Find available frequencies in h5 file
-            freqs = np.array([int(x[3:]) for x in list(self.h5f.keys()) if 'X1_' in x])
-            freqs.sort()
-
-        # find the nearest freq lookup table
-        pos = np.argmin(np.abs(freqs - target_freq_Hz))
-        self.freq = freqs[pos]
-        logger.info("%s MHz requested, selecting nearest freq: %s MHz" % (target_freq_Hz / 1.e6, self.freq / 1.e6))
+            logger.info("%s MHz requested, selecting nearest freq: %s MHz" % (target_freq_Hz / 1.e6, self.freq / 1.e6))
+        self._coeffs = None
+
+    def get_coefficients(self):
+        """Return (Q, M, N), the spherical wave coefficients of all antennas at this frequency
+        (see load_h5_coefficients). They are read from the h5 file on first use only, so that
+        forming a beam for any set of delays and amplitudes is a single matrix-vector product.
+        With linear frequency interpolation, Q is the weighted sum of the coefficients of the
+        two tabulated frequencies, so a beam costs the same as at a tabulated frequency."""
+        if self._coeffs is None:
+            coeffs = [(weight, self.get_tabulated_coefficients(freq)) for (freq, weight) in self.freq_weights]
+            if len(coeffs) == 1:
+                self._coeffs = coeffs[0][1]
+            else:
+                # the modes are in FEKO order, so the modes of the frequency with fewer modes are
+                # the first modes of the other one
+                n_mn = max([len(c[1]) for (w, c) in coeffs])
+                Q = np.zeros((2, self.n_ant, 2 * n_mn), dtype=np.complex128)
+                for (weight, (Q_tab, M_tab, N_tab)) in coeffs:
+                    n_tab = len(M_tab)
+                    Q[:, :, 0:n_tab] += weight * Q_tab[:, :, 0:n_tab]
+                    Q[:, :, n_mn:n_mn + n_tab] += weight * Q_tab[:, :, n_tab:]
+                    if n_tab == n_mn:
+                        (M, N) = (M_tab, N_tab)
+                self._coeffs = (Q, M, N)
+        return self._coeffs
+
+    def get_tabulated_coefficients(self, freq):
+        """Return (Q, M, N) of the tabulated frequency freq (Hz), see load_h5_coefficients.
+        They are kept in COEFFICIENT_CACHE, so that e.g. the ApertureArray objects of
+        many channels between two tabulated frequencies only read them from the h5 file once.
+        For a compiled store (see compile_coefficients) they are read-only views of the memory mapped store."""
+        if self.store is not None:
+            return self.store.get_coefficients(freq)
+
+        def load():
+            coeffs = load_h5_coefficients(self.h5f, freq, n_ant=self.n_ant)
+            for a in coeffs:
+                a.flags.writeable = False    # shared by all ApertureArray objects
+            return coeffs
+
+        key = (beam_cache.file_stamp(self.h5filepath), self.n_ant, freq)
+        return COEFFICIENT_CACHE.get_or_create(key, load)
+
+    @property
+    def Q(self):
+        return self.get_coefficients()[0]
+
+    @property
+    def M(self):
+        return self.get_coefficients()[1]
+
+    @property
+    def N(self):
+        return self.get_coefficients()[2]
+
+    def get_nbytes(self):
+        """Return the memory (bytes) used by this object, i.e. its own (interpolated) coefficients.
+        Coefficients of tabulated frequencies (see COEFFICIENT_CACHE) and gridded beams (see GRID_CACHE)
+        are shared and not included."""
+        if (self._coeffs is not None) and (len(self.freq_weights) > 1):
+            return beam_cache.get_nbytes(self._coeffs)
+        return 0
+
+    def get_cache_key(self, *parts):
+        """Return a key for the disk cache (see beam_cache) identifying data calculated
+        from the coefficients of this object and the given parts"""
+        return beam_cache.make_key(self.get_model_hash(), self.n_ant, self.freq, self.freq_weights, *parts)
+
+    def get_model_hash(self):
+        """Return the content hash of the h5 file of the model (also for a store compiled from it)"""
+        if self.store is not None:
+            return self.store.h5_hash
+        return beam_cache.file_hash(self.h5filepath)
+
+    def get_model_stamp(self):
+        """Return a cheap key identifying the model for in-process caches: the content hash
+        recorded in a compiled store, or beam_cache.file_stamp of the h5 file (see get_model_hash)"""
+        if self.store is not None:
+            return self.store.h5_hash
+        return beam_cache.file_stamp(self.h5filepath)
 
     def calc_zenith_norm_fac(self):
         """Calculate normalisation factors for the Jones vector for this
@@ -133,19 +256,18 @@ class ApertureArray(object):
         pointing east, i.e. when ph_EtN=0 (ph_NtE=90). For the phi unit vec,
         this will be when ph_EtN=-90 or 90 (ph_NtE=180 or 0: we use 180)
         For the N-S dipoles, projection of ZA onto N-S is max az ph_EtN=90 (ph_NtE=0) and
-        proj of ph onto N-S is max when ph_EtN=0 (ph_NtE=90)"""
+        proj of ph onto N-S is max when ph_EtN=0 (ph_NtE=90)
 
-        mybeam = Beam(self, delays=np.zeros([2, 16]), amps=np.ones([2, 16]))
-        self.norm_fac = np.zeros((2, 2), dtype=np.complex128)
+        The Jones matrices of the tabulated frequencies are taken from a table (see get_zenith_jones),
+        and as the beam is linear in the coefficients, for linear frequency interpolation the
+        Jones matrix is the same weighted sum of those of the two tabulated frequencies."""
 
         # fill in Jones matrix
         # 2017-05-31 : MS changed normalisation at zenith to ABS so that normalisation does not change signs of the Jones matrix
         #              otherwise signs might flip again, at the moment they are as the Jones matrix is calculated and normalisation does not mess up with it
         #              It probably needs some proper normalisation which Adrian and Daniel and a bit MS are still working on ...
-        max_phis = [[math.pi / 2, math.pi], [0, math.pi / 2]]  # phi where each Jones vector is max
-        for i in [0, 1]:
-            for ii in [0, 1]:
-                self.norm_fac[i][ii] = abs(mybeam.get_response(max_phis[i][ii], 0)[i][ii][0])  # or with abs
+        zenith_jones = sum([weight * get_zenith_jones(self, freq) for (freq, weight) in self.freq_weights])
+        self.norm_fac = np.abs(zenith_jones).astype(np.complex128)  # or with abs
 
         # print "----------------------------------------------------------------"
         # print "Normalisation Jones matrix :"
@@ -163,29 +285,314 @@ class ApertureArray(object):
         if self.norm_fac is None:
             self.calc_zenith_norm_fac()
         # Resize to extra dimensions for subsequent broadcasting during normalisation
-        mynorm_fac = np.copy(self.norm_fac)
+        mynorm_fac = np.copy(self.norm_fac).astype(np.result_type(j.dtype, np.complex64))  # keep single precision
         for i in range(len(j.shape) - 2):
             mynorm_fac = np.expand_dims(mynorm_fac, axis=2)
         return j / mynorm_fac  # Normalise
         # return j    # normalisation turned off for tests
 
 
-def get_AA_Cached(target_freq_Hz=None):
+def select_freqs(freqs, target_freq_Hz, freq_interp='nearest'):
+    """Return (freq, freq_weights), the frequency of the model for target_freq_Hz and a list of
+    (tabulated frequency, weight) of the coefficients to combine.
+
+    Input:
+    freqs - sorted array of the tabulated frequencies (Hz)
+    target_freq_Hz - frequency at which beam model is required
+    freq_interp - 'nearest' for the nearest tabulated frequency, or 'linear' for the two tabulated
+                  frequencies either side of target_freq_Hz (the nearest outside of the tabulated range)
+    """
+    pos = np.searchsorted(freqs, target_freq_Hz)
+    if (freq_interp == 'linear') and (0 < pos < len(freqs)) and (freqs[pos] != target_freq_Hz):
+        # weights of the two tabulated frequencies either side of the target frequency
+        (freq_lo, freq_hi) = (int(freqs[pos - 1]), int(freqs[pos]))
+        weight_hi = float(target_freq_Hz - freq_lo) / (freq_hi - freq_lo)
+        return (target_freq_Hz, [(freq_lo, 1 - weight_hi), (freq_hi, weight_hi)])
+    # find the nearest freq lookup table
+    pos = np.argmin(np.abs(freqs - target_freq_Hz))
+    return (freqs[pos], [(int(freqs[pos]), 1.0)])
+
+
+def get_AA_Cached(target_freq_Hz=None, freq_interp='nearest'):
     """
     Create an ApertureArray object with the default h5file path and n_ant, pre-calculate the zenith_norm_fac, and
-    cache it to use next time the saem target_freq_Hz is requested.
+    cache it to use next time the same model frequency is requested.
+
+    The cache is keyed by the frequency of the model rather than target_freq_Hz, so all the frequencies mapping
+    to the same tabulated frequency (freq_interp='nearest') share one object. It is thread-safe and bounded by
+    config.AA_CACHE_MAX_ENTRIES and config.AA_CACHE_MAX_BYTES, evicting the least recently used objects first
+    (see get_AA_cache_stats).
 
     :param target_freq_Hz: Frequency in Hertz
+    :param freq_interp: 'nearest' or 'linear' frequency interpolation, see ApertureArray
     :return: an ApartureArray object
     """
-    if target_freq_Hz in AACACHE:
-        return AACACHE[target_freq_Hz]
-    else:
-        a = ApertureArray(config.h5file, target_freq_Hz)
+    model_path = get_model_path()
+    model_freq = select_freqs(get_tabulated_freqs(model_path), target_freq_Hz, freq_interp)[0]
+
+    def create():
+        a = ApertureArray(model_path, model_freq, freq_interp=freq_interp)
         a.calc_zenith_norm_fac()
-        AACACHE[target_freq_Hz] = a
+        a.get_coefficients()    # read now, so that the size of the object does not change once cached
         return a
 
+    key = (model_path, freq_interp, model_freq)
+    return AACACHE.get_or_create(key, create)
+
+
+def get_AA_cache_stats():
+    """Return a dictionary with the hits, misses, evictions, number of entries and bytes used
+    of the cache of ApertureArray objects of get_AA_Cached (their gridded beams are in GRID_CACHE)"""
+    return AACACHE.stats()
+
+
+def calc_zenith_jones(Q, M, N):
+    """Return the complex Jones matrix used for the zenith normalisation (see
+    ApertureArray.calc_zenith_norm_fac), i.e. element [i][ii] of the Jones matrix of the zenith
+    pointed beam (all delays 0 and amplitudes 1) at the zenith, at the phi where it is maximum.
+
+    Input:
+    Q, M, N - coefficients of all antennas at one frequency, see load_h5_coefficients"""
+    # with zero delays and unit amplitudes the accumulated modes are the sums over the antennas
+    n_mn = len(M)
+    Q_accum = Q.sum(axis=1)
+    max_phis = [math.pi / 2, math.pi, 0]   # phi where each Jones vector is max: [[pi/2, pi], [0, pi/2]]
+    basis = DirectionBasis(max_phis, np.zeros(3), int(np.max(N)))
+    jones = basis.get_jones(Q_accum[:, 0:n_mn], Q_accum[:, n_mn:])
+    return np.array([[jones[0, 0, 0], jones[0, 1, 1]],
+                     [jones[1, 0, 2], jones[1, 1, 0]]])
+
+
+def get_zenith_jones(AA, freq):
+    """Return calc_zenith_jones for the tabulated frequency freq (Hz) of the model of ApertureArray AA.
+
+    The values for all the tabulated frequencies are calculated once per model and kept in ZENITH_JONES:
+    they are read from the compiled coefficient store (see compile_coefficients) or, if the disk cache
+    is enabled (see beam_cache), calculated for all the frequencies of the h5 file and saved in the disk
+    cache. Otherwise only the requested frequency is calculated."""
+    table = ZENITH_JONES.setdefault((AA.get_model_stamp(), AA.n_ant), {})
+    if freq in table:
+        return table[freq]
+
+    if (AA.store is not None) and (AA.store.zenith_jones is not None):
+        table.update(zip(AA.store.freqs, AA.store.zenith_jones))
+    elif AA.store is None:
+        cache = beam_cache.get_disk_cache()
+        if cache is not None:
+            cache_key = beam_cache.make_key('zenith_jones', AA.get_model_hash(), AA.n_ant)
+            entry = cache.load(cache_key)
+            if entry is None:
+                freqs = get_tabulated_freqs(AA.h5filepath)
+                logger.debug('Calculating zenith normalisation of %s frequencies' % len(freqs))
+                entry = {'freqs': freqs, 'zenith_jones': calc_zenith_jones_table(AA.h5f, freqs, n_ant=AA.n_ant)}
+                cache.save(cache_key, **entry)
+            table.update(zip(entry['freqs'], entry['zenith_jones']))
+
+    if freq not in table:
+        table[freq] = calc_zenith_jones(*AA.get_tabulated_coefficients(freq))
+    return table[freq]
+
+
+def calc_zenith_jones_table(h5f, freqs, n_ant=16):
+    """Return calc_zenith_jones for all the frequencies freqs of an h5 file, shape (len(freqs), 2, 2)"""
+    return np.array([calc_zenith_jones(*load_h5_coefficients(h5f, freq, n_ant=n_ant)) for freq in freqs])
+
+
+def get_model_path():
+    """Return the path of the default full EE model: config.coefficient_store if set, otherwise config.h5file"""
+    if config.coefficient_store:
+        return config.coefficient_store
+    return config.h5file
+
+
+def get_tabulated_freqs(h5filepath=None):
+    """Return the sorted array of tabulated frequencies (Hz) of an h5 file or compiled
+    coefficient store (by default, the default model of get_model_path)"""
+    if h5filepath is None:
+        h5filepath = get_model_path()
+    if os.path.isdir(h5filepath):
+        return get_coefficient_store(h5filepath).freqs
+    return get_h5file(h5filepath)[1]
+
+
+def get_h5file(h5filepath=None):
+    """Return (h5f, freqs), the h5py File object of an h5 file (config.h5file by default) and
+    the sorted array of its tabulated frequencies (Hz).
+    The file is opened on first use (not on import of this module) and kept open in H5FILES."""
+    if h5filepath is None:
+        h5filepath = config.h5file
+    if h5filepath not in H5FILES:
+        if h5py is None:
+            e = 'Cannot import h5py module, needed to read beam model file %s' % h5filepath
+            logger.error(e)
+            raise ImportError(e)
+        if not os.path.exists(h5filepath):
+            logger.error('Cannot find beam model file %s' % h5filepath)
+            raise IOError('h5 file not found at specified location: %s' % h5filepath)
+        logger.debug('Loading beam model from file %s' % h5filepath)
+        if h5filepath == config.h5file:
+            logger.debug("H5 file (%s) version = %s" % (config.h5file, config.h5fileversion))
+        h5f = h5py.File(h5filepath, 'r')
+        # Find available frequencies in h5 file
+        freqs = np.array([int(x[3:]) for x in list(h5f.keys()) if 'X1_' in x])
+        freqs.sort()
+        H5FILES[h5filepath] = (h5f, freqs)
+    return H5FILES[h5filepath]
+
+
+def get_coefficient_store(store_dir):
+    """Return the CoefficientStore of a directory created by compile_coefficients,
+    opened once and kept in COEFFICIENT_STORES"""
+    key = os.path.abspath(store_dir)
+    if key not in COEFFICIENT_STORES:
+        COEFFICIENT_STORES[key] = CoefficientStore(store_dir)
+    return COEFFICIENT_STORES[key]
+
+
+def compile_coefficients(h5filepath, store_dir, n_ant=16):
+    """Convert the coefficients of all the tabulated frequencies of an h5 file into a store of
+    numpy files in the directory store_dir (see CoefficientStore), which can then be used instead
+    of the h5 file: ApertureArray(store_dir, freq), or config.coefficient_store = store_dir.
+
+    The store holds the (zero padded) complex Q tensors of load_h5_coefficients of all frequencies
+    in one array (Q.npy), which is memory mapped when it is used, and the frequencies, mode
+    vectors, offsets of each frequency and the zenith normalisation table (see get_zenith_jones)
+    in index.npz.
+
+    Input:
+    h5filepath - path to h5 file containing coefficients
+    store_dir - directory of the store, created if needed (an existing store is replaced)
+    n_ant - number of antennas in array/tile
+    """
+    (h5f, freqs) = get_h5file(h5filepath)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    # modes of the frequency with the most modes, all the others are the first modes (FEKO order)
+    n_mn = np.zeros(len(freqs), dtype=np.int64)
+    offsets = np.zeros(len(freqs) + 1, dtype=np.int64)
+    (M, N) = (np.zeros(0), np.zeros(0))
+    zenith_jones = np.zeros((len(freqs), 2, 2), dtype=np.complex128)
+    for i, freq in enumerate(freqs):
+        n_mn[i] = max([h5f['%s%s_%s' % (pol, ant_i + 1, freq)].shape[1] // 2
+                       for pol in ['X', 'Y'] for ant_i in range(n_ant)])
+        offsets[i + 1] = offsets[i] + 2 * n_ant * 2 * n_mn[i]
+
+    logger.info('Compiling coefficients of %s frequencies of %s into %s' % (len(freqs), h5filepath, store_dir))
+    tmp_Q_path = os.path.join(store_dir, 'Q.npy.tmp')
+    Q_all = np.lib.format.open_memmap(tmp_Q_path, mode='w+', dtype=np.complex128, shape=(int(offsets[-1]),))
+    for i, freq in enumerate(freqs):
+        (Q, M_freq, N_freq) = load_h5_coefficients(h5f, freq, n_ant=n_ant)
+        Q_all[offsets[i]:offsets[i + 1]] = Q.ravel()
+        zenith_jones[i] = calc_zenith_jones(Q, M_freq, N_freq)
+        if len(M_freq) > len(M):
+            (M, N) = (M_freq, N_freq)
+    Q_all.flush()
+    del Q_all
+
+    tmp_index_path = os.path.join(store_dir, 'index.npz.tmp')
+    with open(tmp_index_path, 'wb') as f:
+        np.savez(f, freqs=freqs, n_mn=n_mn, offsets=offsets, M=M, N=N, n_ant=n_ant, zenith_jones=zenith_jones,
+                 h5_hash=np.array(beam_cache.file_hash(h5filepath)),
+                 h5_file_version=np.array(str(config.h5fileversion) if h5filepath == config.h5file else ''))
+    # move into place, the index last, as it is read first
+    beam_cache.atomic_replace(tmp_Q_path, os.path.join(store_dir, 'Q.npy'))
+    beam_cache.atomic_replace(tmp_index_path, os.path.join(store_dir, 'index.npz'))
+    COEFFICIENT_STORES.pop(os.path.abspath(store_dir), None)
+
+
+class CoefficientStore(object):
+    """Spherical wave coefficients of all the tabulated frequencies of an h5 file, compiled by
+    compile_coefficients into a directory of numpy files.
+
+    The coefficients are memory mapped read-only, so reading a frequency costs no more than
+    touching its pages, and all the processes using the same store share one copy of it in the
+    OS page cache (instead of each holding its own h5py copy of the data)."""
+
+    def __init__(self, store_dir):
+        logger.debug('Loading compiled beam model coefficients from %s' % store_dir)
+        self.store_dir = store_dir
+        with np.load(os.path.join(store_dir, 'index.npz')) as index:
+            self.freqs = index['freqs']
+            self.n_mn = index['n_mn']
+            self.offsets = index['offsets']
+            self.M = index['M']
+            self.N = index['N']
+            self.n_ant = int(index['n_ant'])
+            self.h5_hash = str(index['h5_hash'])
+            self.h5_file_version = str(index['h5_file_version']) or None    # None if unknown
+            # not in stores compiled before the zenith normalisation table was added
+            self.zenith_jones = index['zenith_jones'] if 'zenith_jones' in index.files else None
+        for a in [self.freqs, self.n_mn, self.offsets, self.M, self.N]:
+            a.flags.writeable = False
+        self.Q = np.load(os.path.join(store_dir, 'Q.npy'), mmap_mode='r')
+
+    def get_coefficients(self, freq):
+        """Return (Q, M, N) of the tabulated frequency freq (Hz), see load_h5_coefficients"""
+        pos = np.flatnonzero(self.freqs == freq)
+        if len(pos) == 0:
+            e = 'Frequency %s Hz is not in the coefficient store %s' % (freq, self.store_dir)
+            logger.error(e)
+            raise ValueError(e)
+        i = pos[0]
+        n_mn = int(self.n_mn[i])
+        Q = self.Q[self.offsets[i]:self.offsets[i + 1]].reshape((2, self.n_ant, 2 * n_mn))
+        return (Q, self.M[0:n_mn], self.N[0:n_mn])
+
+
+def load_h5_coefficients(h5f, freq, n_ant=16):
+    """Read the spherical wave coefficients of all antennas at one tabulated frequency
+    into a dense complex tensor.
+
+    Input:
+    h5f - open h5py File object with the embedded element coefficients
+    freq - tabulated frequency (Hz), as used in the dataset names
+    n_ant - number of antennas in array/tile
+
+    Output:
+    Q - complex array of shape (2, n_ant, 2 * n_mn) where the 1st dimension is the
+        antenna pol (X, Y), the 2nd the antenna number and the last dimension holds
+        the Q1mn coefficients followed by the Q2mn coefficients in FEKO M,N order.
+        Antennas with fewer modes than the largest are zero padded.
+    M, N - mode vectors of length n_mn shared by all antennas and both pols"""
+
+    pols = ['X', 'Y']
+    Q_modes_all = h5f['modes'][()].T
+
+    # finding maximum length of modes for this frequency (over both pols)
+    n_mn = 0
+    for pol in [0, 1]:
+        for ant_i in range(n_ant):
+            name = '%s%s_%s' % (pols[pol], ant_i + 1, freq)
+            n_mn = max(n_mn, h5f[name].shape[1] // 2)
+
+    # M and N of the antenna with the most modes, the others are a subset (FEKO order)
+    s1 = Q_modes_all[0:2 * n_mn, 0] <= 1
+    M = Q_modes_all[0:2 * n_mn][s1, 1]
+    N = Q_modes_all[0:2 * n_mn][s1, 2]
+
+    Q = np.zeros((2, n_ant, 2 * n_mn), dtype=np.complex128)
+    for pol in [0, 1]:
+        for ant_i in range(n_ant):
+            # select spherical wave table
+            name = '%s%s_%s' % (pols[pol], ant_i + 1, freq)
+            Q_all = h5f[name][()].T
+
+            # current length
+            my_len = np.max(Q_all.shape)
+            my_len_half = my_len // 2
+
+            # find s=1 and s=2 indices for this antenna
+            Q_modes = Q_modes_all[0:my_len, :]
+            s1 = Q_modes[:, 0] <= 1
+            s2 = Q_modes[:, 0] > 1
+
+            # grab Q1mn and Q2mn and make them complex
+            Q[pol, ant_i, 0:my_len_half] = Q_all[s1, 0] * np.exp(1.0j * Q_all[s1, 1] * deg2rad)
+            Q[pol, ant_i, n_mn:n_mn + my_len_half] = Q_all[s2, 0] * np.exp(1.0j * Q_all[s2, 1] * deg2rad)
+
+    return (Q, M, N)
+
 
 class Beam(object):
     def __init__(self, AA, delays=None, amps=None):
@@ -289,82 +696,88 @@ class Beam(object):
     def calc_beam_modes(self):
         """Calculate (accumulate) modes for beam object initialised
         with delays and amplitudes"""
+        # the accumulated modes only depend on the h5 file, frequency, delays and amplitudes,
+        # so they can be shared between processes through the (optional) disk cache
+        cache = beam_cache.get_disk_cache()
+        if cache is not None:
+            key = self.AA.get_cache_key('beam_modes', np.asarray(self.delays, dtype=np.float64),
+                                        np.asarray(self.amps, dtype=np.float64))
+            entry = cache.load(key)
+            if entry is not None:
+                self.set_beam_modes(entry['Q_accum'], entry['M'], entry['N'])
+                return
+
+        logger.debug('Calculate (accumulate) modes for X and Y-pol beams. Time is %s' % datetime.datetime.now().time())
+
+        # Calculate complex excitation voltages, shape (2, n_ant)
+        Vcplx = calc_excitations(self.AA.freq, self.delays, self.amps)
+
+        # accumulate Q1 and Q2 of all antennas, scaled by excitation voltage, for both pols at once
+        (Q, M, N) = self.AA.get_coefficients()
+        Q_accum = np.einsum('pa,pak->pk', Vcplx, Q)
+        self.set_beam_modes(Q_accum, M, N)
+
+        if cache is not None:
+            cache.save(key, Q_accum=Q_accum, M=M, N=N)
+
+    def set_beam_modes(self, Q_accum, M, N):
+        """Set the beam modes from accumulated coefficients Q_accum of shape (2, 2 * len(M)),
+        holding the Q1 followed by the Q2 coefficients for the X and Y pols"""
+        n_mn = len(M)
         self.beam_modes = {}
         pols = ['X', 'Y']
         for pol in [0, 1]:
-            logger.debug('Calculate (accumulate) modes for %s-pol beam. Time is %s' % (pols[pol],
-                                                                                       datetime.datetime.now().time()))
-            # Calculate complex excitation voltages
-            phases = 2 * math.pi * self.AA.freq * (-self.delays[pol]) * 435e-12  # convert delay to phase
-            Vcplx = self.amps[pol] * np.exp(1.0j * phases)  # complex excitation col voltage
-
-            # sum up modes to create beam described by spherical harmonics
-            logger.debug('determine theta-dependent component...')
-
-            # finding maximum length of modes for this frequency
-            max_length = 0  # initialize
-            n_ant = self.AA.n_ant  # Was hardcoded to 16
-            for ant_i in range(n_ant):
-                # select spherical wave table
-                name = '%s%s_%s' % (pols[pol], ant_i + 1, self.AA.freq)
-
-                # find maximum length
-                if self.AA.h5f[name].shape[1] // 2 > max_length:
-                    max_length = self.AA.h5f[name].shape[1] // 2
-
-            # accumulating spherical harmonics coefficients for the array
-            # initialize
-            Q1_accum = np.zeros(max_length, dtype=np.complex128)
-            Q2_accum = np.zeros(max_length, dtype=np.complex128)
-
-            # Read in modes
-            Q_modes_all = self.AA.h5f['modes'].value.T
-            Nmax = 0
-            M_accum = None
-            N_accum = None
-            for ant_i in range(n_ant):
-                # re-initialise Q1 and Q2 for every antenna
-                Q1 = np.zeros(max_length, dtype=np.complex128)
-                Q2 = np.zeros(max_length, dtype=np.complex128)
-
-                # select spherical wave table
-                name = '%s%s_%s' % (pols[pol], ant_i + 1, self.AA.freq)
-                Q_all = self.AA.h5f[name].value.T
-
-                # current length
-                my_len = np.max(Q_all.shape)
-                my_len_half = my_len // 2
-
-                Q_modes = Q_modes_all[0:my_len, :]  # Get modes for this antenna
-
-                # convert Qall to M, N, Q1, Q2 vectors for processing
-
-                # find s=1 and s=2 indices
-                # only find s1 and s2 for this antenna
-                s1 = Q_modes[0:my_len, 0] <= 1
-                s2 = Q_modes[0:my_len, 0] > 1
-
-                # grab m,n vectors
-                M = Q_modes[s1, 1]
-                N = Q_modes[s1, 2]
-
-                # update to the larger M and N
-                if np.max(N) > Nmax:
-                    M_accum = M
-                    N_accum = N
-                    Nmax = np.max(N_accum)
-
-                # grab Q1mn and Q2mn and make them complex
-                Q1[0:my_len_half] = Q_all[s1, 0] * np.exp(1.0j * Q_all[s1, 1] * deg2rad)
-                Q2[0:my_len_half] = Q_all[s2, 0] * np.exp(1.0j * Q_all[s2, 1] * deg2rad)
-
-                # accumulate Q1 and Q2, scaled by excitation voltage
-                Q1_accum += Q1 * Vcplx[ant_i]
-                Q2_accum += Q2 * Vcplx[ant_i]
-            self.beam_modes[pols[pol]] = {'Q1': Q1_accum, 'Q2': Q2_accum,
-                                          'M': M_accum, 'N': N_accum}
-
-    def get_response(self, phi_arr, theta_arr):
+            self.beam_modes[pols[pol]] = {'Q1': Q_accum[pol, 0:n_mn], 'Q2': Q_accum[pol, n_mn:],
+                                          'M': M, 'N': N}
+
+    def truncate_modes(self, rel_tol):
+        """Drop the trailing degrees n of the accumulated modes which carry a fraction of the power
+        of the beam no larger than rel_tol, so that the beam is evaluated with a lower nmax
+        (e.g. rel_tol=1e-6 for a survey, where the model itself is not more accurate).
+
+        The spherical wave modes are orthogonal with equal norms over the sphere, so the fraction of the power
+        of the dropped modes, sum(|Q1|^2 + |Q2|^2) over the dropped modes divided by that over all
+        the modes, is the mean squared error of the far field over the sphere relative to its mean
+        squared value. The larger fraction of the two pols is used.
+
+        The modes of the beam are replaced (get_nmax returns the reduced nmax), calc_beam_modes
+        restores all of them.
+
+        Input:
+        rel_tol - maximum fraction of the power of the dropped modes
+
+        Output:
+        (nmax, rel_error) - the reduced nmax and the fraction of the power of the dropped modes"""
+        if not (rel_tol >= 0):
+            e = 'Invalid tolerance %s of the mode truncation' % rel_tol
+            logger.error(e)
+            raise ValueError(e)
+        (Q1, Q2) = self.get_modes()
+        N = self.beam_modes['X']['N']
+        nmax_full = self.get_nmax()
+
+        # power of each degree n=1..nmax for each pol, and of the degrees above each n
+        power = np.abs(Q1) ** 2 + np.abs(Q2) ** 2
+        power_n = np.array([power[:, N == n].sum(axis=-1) for n in range(1, nmax_full + 1)]).T
+        total = power_n.sum(axis=-1)
+        total[total == 0] = 1.
+        tail = (np.cumsum(power_n[:, ::-1], axis=-1)[:, ::-1] - power_n) / total[:, None]
+        tail = tail.max(axis=0)   # tail[n-1] is the fraction of the power of the degrees above n
+
+        nmax = int(np.nonzero(tail <= rel_tol)[0][0]) + 1
+        rel_error = float(tail[nmax - 1])
+        logger.info('Truncating modes from nmax=%s to nmax=%s, relative power of the dropped modes %.3g' %
+                    (nmax_full, nmax, rel_error))
+
+        # modes are in FEKO order, i.e. sorted by degree n
+        n_mn = nmax ** 2 + 2 * nmax
+        for pol in ['X', 'Y']:
+            for name in ['Q1', 'Q2', 'M', 'N']:
+                self.beam_modes[pol][name] = self.beam_modes[pol][name][0:n_mn]
+        return (nmax, rel_error)
+
+    def get_response(self, phi_arr, theta_arr, precision='double', max_memory_bytes=None, out=None,
+                     n_workers=None):
         """Calculate full Jones matrix response (E-field) of beam for
         one or more spherical coordinates
 
@@ -373,6 +786,9 @@ class Beam(object):
 
         phi_arr - azimuth angles (radians), north through east.
         theta_arr - zenith angles (radian)
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis
+        max_memory_bytes, out, n_workers - if any is given, the points are evaluated in chunks
+                                           (see get_FF_chunked)
 
         Output:
         Jones - A multi-dimensional array, comprising an array of shape(phi_arr),
@@ -405,11 +821,15 @@ class Beam(object):
             theta_arr = np.reshape(theta_arr, (1))
             # Calculate for each point
         logger.debug('Calculating beam for each point in %s... %s' % (phi_arr.shape, datetime.datetime.now().time()))
-        Jones = self.get_FF(phi_arr, theta_arr, grid=False)
+        if (max_memory_bytes is None) and (out is None) and (n_workers is None):
+            Jones = self.get_FF(phi_arr, theta_arr, grid=False, precision=precision)
+        else:
+            Jones = self.get_FF_chunked(phi_arr, theta_arr, max_memory_bytes=max_memory_bytes, out=out,
+                                        precision=precision, n_workers=n_workers)
 
         return Jones
 
-    def get_interp_response(self, phi_arr, theta_arr, pixels_per_deg=5):
+    def get_interp_response(self, phi_arr, theta_arr, pixels_per_deg=5, plan=None, precision='double'):
         """Calculate full Jones matrix response (E-field) of beam interpolated
         from a beam calculated on a 2-D grid of spherical coordinates at
         resolution pixels_per_deg pixels per degree.
@@ -425,6 +845,11 @@ class Beam(object):
         theta_arr - zenith angles (radian)
         pixels_per_deg - number of pixels per degree along phi and theta axes
                         which is then interpolarted on the phi_arr,theta_arr coords
+        plan - optional InterpPlan for these coordinates (e.g. reused for several
+               beams or frequencies), in which case phi_arr, theta_arr and
+               pixels_per_deg are ignored
+        precision - 'double' (complex128) or 'single' (complex64) gridded beam and result,
+                    see DirectionBasis
 
         Output:
         Jones - A 4-D array, comprising a 2-D array of shape(phi_arr),
@@ -433,58 +858,132 @@ class Beam(object):
         [J_21=Ytheta J_21=Yphi]
         """
 
-        # RegularGridInterpolator only needed for this function.
-        # FIXME: version check, as it's not available on earlier scipy versions
+        if plan is None:
+            # Convert to numpy array (if not already numpy array)
+            try:
+                phi_arr = np.array(phi_arr, copy=False, ndmin=1)
+                theta_arr = np.array(theta_arr, copy=False, ndmin=1)
+            except Exception:
+                e = 'Unable to convert theta and phi to numpy arrays'
+                logger.error(e)
+                raise ValueError(e)
+            plan = InterpPlan(phi_arr, theta_arr, pixels_per_deg)
 
-        # TODO: find min & max of phi_arr & theta_arr so that a subset of the
-        # grid can be calculated (instead of the whole 0-360, 0-90 grid)
+        logger.debug('Calculating a gridded beam and interpolating onto coordinates of shape %s...' % (plan.shape,))
+        if plan.pixels_per_deg < 5:
+            logger.warning("Resolution along theta, phi axes is less than 5 pixels per degree. Results may be less reliable")
 
-        # Convert to numpy array (if not already numpy array)
-        try:
-            phi_arr = np.array(phi_arr, copy=False, ndmin=1)
-            theta_arr = np.array(theta_arr, copy=False, ndmin=1)
-        except Exception:
-            e = 'Unable to convert theta and phi to numpy arrays'
-            logger.error(e)
-            raise ValueError(e)
+        # Calculate beam for a phi (NtE), theta grid with angular resolution specified by pixels_per_deg,
+        # but only over the region of the (Az=0-360, ZA=0-90) grid covering the requested coordinates.
+        logger.debug('Calculating gridded beam (Az=%.2f-%.2f, ZA=%.2f-%.2f) at angular resolution %s pixels per degree... %s' %
+                     (plan.phi_1D[0] * rad2deg, plan.phi_1D[-1] * rad2deg,
+                      plan.theta_1D[0] * rad2deg, plan.theta_1D[-1] * rad2deg,
+                      plan.pixels_per_deg, datetime.datetime.now().time()))
+        gridded_Jones = self.get_gridded_response(plan.pixels_per_deg, plan.phi_range, plan.theta_range,
+                                                  precision=precision)
 
-        # change negative azimuths to positive ones, otherwise it won't work with the interpolation function below
-#        phi_arr[phi_arr < 0] += 2.0 * math.pi
-        
-        # print "DEBUG = %s" % (phi_arr)
+        logger.debug('Interpolating... %s' % datetime.datetime.now().time())
+        Jones = plan.interpolate(gridded_Jones)
+        logger.debug('Done... %s' % datetime.datetime.now().time())
 
-        logger.debug('Calculating a gridded beam and interpolating onto coordinates of shape %s...' % (phi_arr.shape,))
-        # Interpolate from gridded beam
-        Jones = np.zeros((2, 2) + np.shape(phi_arr), dtype=np.complex128)
+        return Jones
 
-        logger.debug('Calculating gridded beam (Az=0-360, ZA=0-90) at angular resolution %s pixels per degree... %s' %
-                     (pixels_per_deg, datetime.datetime.now().time()))
-        if pixels_per_deg < 5:
-            logger.warning("Resolution along theta, phi axes is less than 5 pixels per degree. Results may be less reliable")
+    def get_gridded_response(self, pixels_per_deg=5, phi_range=None, theta_range=None, precision='double',
+                             phi_fft=None):
+        """Return the Jones matrices of the beam on the phi (Az=0-360), theta (ZA=0-90) grid
+        returned by get_grid('rad', pixels_per_deg), shape (2, 2, n_phi, n_theta),
+        or on a region of it.
 
-            # Calculate beam for a phi (NtE), theta grid with angular resolution specified by pixels_per_deg.
+        Input:
+        pixels_per_deg - number of pixels per degree along phi and theta axes
+        phi_range, theta_range - optional (start, stop) indices of the grid points along the
+                                 phi and theta axes to calculate (see get_grid_region). The phi
+                                 indices may extend beyond 0-360 deg, to cover the azimuth wrap.
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis
+        phi_fft - whether to do the sum over m with an FFT along phi: None to choose automatically,
+                  True to use it whenever the phi axis allows it, False never (see DirectionBasis)
+
+        The result is cached (read-only) in GRID_CACHE, keyed by the model, the frequency,
+        the accumulated modes (i.e. delays and amplitudes), pixels_per_deg, the region and the precision,
+        so that repeated calls for the same beam only calculate it once. The memory used by the cache
+        (for all frequencies) is limited to config.GRIDDED_BEAM_CACHE_MAX_BYTES and its hits and misses
+        are available from GRID_CACHE.stats()"""
         mygrid = get_grid('rad', pixels_per_deg)
-        gridded_Jones = self.get_FF(mygrid['phi_1D'], mygrid['theta_1D'], grid=True)
+        if phi_range is None:
+            phi_range = (0, len(mygrid['phi_1D']))
+        if theta_range is None:
+            theta_range = (0, len(mygrid['theta_1D']))
+        phi_range = (int(phi_range[0]), int(phi_range[1]))
+        theta_range = (int(theta_range[0]), int(theta_range[1]))
+
+        (Q1, Q2) = self.get_modes()
+        key = (self.AA.get_model_stamp(), self.AA.n_ant,
+               beam_cache.make_key('grid', self.AA.freq, Q1, Q2, pixels_per_deg, phi_range, theta_range,
+                                   config.xy_phase_deg, precision))
+        gridded_Jones = GRID_CACHE.get(key)
+        if gridded_Jones is None:
+            degs_per_pixel = 1. / pixels_per_deg
+            phi_1D = np.arange(phi_range[0], phi_range[1]) * degs_per_pixel * deg2rad
+            theta_1D = np.arange(theta_range[0], theta_range[1]) * degs_per_pixel * deg2rad
+            basis = DirectionBasis(phi_1D, theta_1D, self.get_nmax(), grid=True, precision=precision,
+                                   phi_fft=phi_fft)
+            gridded_Jones = self.get_FF(phi_1D, theta_1D, grid=True, basis=basis)
+            gridded_Jones.flags.writeable = False
+            GRID_CACHE.put(key, gridded_Jones)
+        return gridded_Jones
+
+    def get_healpix_response(self, nside, basis=None, precision='double'):
+        """Return the Jones matrices of the beam for the pixels of a HEALPix map of resolution
+        nside (RING ordering) above the horizon, where the pole of the map is the zenith,
+        shape (2, 2, 2*nside*(3*nside+1)) (see HealpixBasis and beam_tools.makeAZZA_healpix
+        for the coordinates of the pixels)
 
-        logger.debug('Interpolating... %s' % datetime.datetime.now().time())
-        for i in [0, 1]:
-            for ii in [0, 1]:
-                # Interpolate real and imag separately (just to be sure) and reconstruct
-                my_interp_fn_real = RegularGridInterpolator((mygrid['phi_1D'], mygrid['theta_1D']),
-                                                            gridded_Jones[i, ii].real,
-                                                            bounds_error=False)  # bounds_error=False interpolates NaNs to NaN
-                my_real = my_interp_fn_real(np.dstack([phi_arr, theta_arr]))
-
-                my_interp_fn_imag = RegularGridInterpolator((mygrid['phi_1D'], mygrid['theta_1D']),
-                                                            gridded_Jones[i, ii].imag,
-                                                            bounds_error=False)  # bounds_error=False interpolates NaNs to NaN
-                my_imag = my_interp_fn_imag(np.dstack([phi_arr, theta_arr]))
-                Jones[i, ii] = my_real + 1j * my_imag
-        logger.debug('Done... %s' % datetime.datetime.now().time())
+        Input:
+        nside - HEALPix resolution parameter
+        basis - optional HealpixBasis for nside (nside and precision are then ignored)
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis"""
+        if basis is None:
+            basis = HealpixBasis(nside, self.get_nmax(), precision=precision)
+        (Q1, Q2) = self.get_modes()
+        return basis.get_jones(Q1, Q2)
+
+    def get_healpix_power(self, nside=64, basis=None):
+        """Return the power patterns (XX, YY) of the beam for the HEALPix pixels above the horizon
+        (see get_healpix_response), together with the HealpixBasis used"""
+        if basis is None:
+            basis = HealpixBasis(nside, self.get_nmax())
+        Jones = self.get_healpix_response(nside, basis=basis)
+        power = (np.abs(Jones) ** 2).sum(axis=1)
+        return (power, basis)
+
+    def get_solid_angle(self, nside=64, basis=None):
+        """Return the solid angles (sr) of the XX and YY power beams normalised to their maximum
+        over the HEALPix pixels above the horizon (see get_healpix_response)
 
-        return Jones
+        Input:
+        nside - HEALPix resolution parameter
+        basis - optional HealpixBasis for nside"""
+        (power, basis) = self.get_healpix_power(nside, basis)
+        return basis.integrate(power) / power.max(axis=-1)
 
-    def get_FF(self, phi_arr, theta_arr, grid):
+    def get_tant(self, sky_T, basis=None):
+        """Return the antenna temperatures (XX, YY) of the beam for a sky brightness temperature map
+        in horizontal coordinates, i.e. the averages of sky_T weighted by the power beams
+
+        Input:
+        sky_T - HEALPix map (RING ordering), where the pole of the map is the zenith and the longitude
+                the azimuth (north through east), of any resolution. Only the pixels above the horizon are used.
+        basis - optional HealpixBasis for the resolution of sky_T"""
+        sky_T = np.asarray(sky_T)
+        nside = int(round((sky_T.shape[-1] / 12.0) ** 0.5))
+        if 12 * nside ** 2 != sky_T.shape[-1]:
+            e = 'Invalid length %s of HEALPix map' % sky_T.shape[-1]
+            logger.error(e)
+            raise ValueError(e)
+        (power, basis) = self.get_healpix_power(nside, basis)
+        return basis.integrate(power * sky_T[..., None, 0:basis.npix]) / basis.integrate(power)
+
+    def get_FF(self, phi_arr, theta_arr, grid, basis=None, precision='double'):
         """
         Converts the beam object's spherical harmonics to a Jones matrix of
         an E-field (polarized in hat{theta} and hat{phi}).
@@ -494,6 +993,9 @@ class Beam(object):
         theta_arr - Array of zenith angles
         grid - If True, will return a 2-D array based on input theta, phi.
                If False will return a array of size of input theta, phi.
+        basis - optional DirectionBasis already calculated for phi_arr, theta_arr and grid
+                (phi_arr, theta_arr, grid and precision are then ignored)
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis
 
         Output:
         #E_P - phi polarized field
@@ -502,147 +1004,892 @@ class Beam(object):
                    sqrt(Zo/(2pi))*7exp(-jbeta r)/r factor
         Sigma_P -  Similarly for Sigma_P"""
 
+        if basis is None:
+            basis = DirectionBasis(phi_arr, theta_arr, self.get_nmax(), grid=grid, precision=precision)
+
+        (Q1, Q2) = self.get_modes()
+        Jones = basis.get_jones(Q1, Q2)
+        return Jones
+
+    def get_FF_chunked(self, phi_arr, theta_arr, max_memory_bytes=None, out=None, precision='double',
+                       n_workers=None):
+        """As get_FF(phi_arr, theta_arr, grid=False), but the points are evaluated in chunks,
+        so that the memory of the intermediate arrays (the basis of each chunk of points and the
+        products with the coefficients) is bounded by max_memory_bytes, whatever the number of points.
+        The results are written into out, which can be a memory-mapped array (e.g. np.memmap
+        or np.lib.format.open_memmap), so that the peak memory does not depend on the number of points.
+
+        The chunks can be evaluated in parallel by n_workers threads (numpy releases the GIL in
+        the heavy parts of the calculation), each of them using up to max_memory_bytes.
+        The chunks only depend on max_memory_bytes, not on n_workers, and each is written into
+        its own part of out, so the result is identical for any number of workers.
+
+        Input:
+        phi_arr - Array of azimuth angles (radians), north through east
+        theta_arr - Array of zenith angles (radians), same shape as phi_arr
+        max_memory_bytes - memory budget of the intermediate arrays (bytes),
+                           config.FF_CHUNK_MAX_BYTES if None
+        out - optional C-contiguous complex array of shape (2, 2) + phi_arr.shape for the result,
+              allocated if None
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis
+        n_workers - number of threads, config.FF_N_WORKERS if None
+
+        Output:
+        Jones - out, the Jones matrices of shape (2, 2) + phi_arr.shape"""
+        phi_arr = np.asarray(phi_arr, dtype=np.float64)
+        theta_arr = np.asarray(theta_arr, dtype=np.float64)
+        if phi_arr.shape != theta_arr.shape:
+            e = 'Theta (shape %s) and phi (shape %s) must be the same shape'
+            logger.error(e % (np.shape(theta_arr), np.shape(phi_arr)))
+            raise ValueError(e % (np.shape(theta_arr), np.shape(phi_arr)))
+        if max_memory_bytes is None:
+            max_memory_bytes = config.FF_CHUNK_MAX_BYTES
+        if n_workers is None:
+            n_workers = config.FF_N_WORKERS
+        if out is None:
+            out = np.empty((2, 2) + phi_arr.shape, dtype=PRECISIONS[precision])
+        elif (out.shape != (2, 2) + phi_arr.shape) or (not out.flags.c_contiguous):
+            e = 'Output array must be C-contiguous with shape %s (not %s)' % ((2, 2) + phi_arr.shape, out.shape)
+            logger.error(e)
+            raise ValueError(e)
+
+        nmax = self.get_nmax()
+        (Q1, Q2) = self.get_modes()
+        n_points = phi_arr.size
+        chunk = int(max(1, max_memory_bytes // DirectionBasis.get_bytes_per_point(nmax, precision)))
+        starts = list(range(0, n_points, chunk))
+        n_workers = max(1, min(int(n_workers), len(starts)))
+        logger.debug('Calculating %s points in %s chunks of %s points with %s threads' %
+                     (n_points, len(starts), chunk, n_workers))
+
+        # flat views of the coordinates and of the output (out is C-contiguous, so writes go into it)
+        phi_flat = phi_arr.reshape(-1)
+        theta_flat = theta_arr.reshape(-1)
+        out_flat = out.reshape((2, 2, n_points))
+
+        def calc_chunk(start):
+            stop = min(start + chunk, n_points)
+            basis = DirectionBasis(phi_flat[start:stop], theta_flat[start:stop], nmax, precision=precision,
+                                   verbose=False)
+            out_flat[:, :, start:stop] = basis.get_jones(Q1, Q2)
+
+        if n_workers == 1:
+            for start in starts:
+                calc_chunk(start)
+        else:
+            pool = ThreadPool(n_workers)
+            try:
+                pool.map(calc_chunk, starts, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        return out
+
+    def get_nmax(self):
+        """Return the maximum degree n of the accumulated modes of this beam"""
+        N = np.concatenate([self.beam_modes['X']['N'], self.beam_modes['Y']['N']])
+        nmax = int(np.max(N))
+        if np.max(N) - nmax != 0:
+            logger.error('The maximum of N should be an integer value!')
+        return nmax
+
+    def get_modes(self):
+        """Return (Q1, Q2), the accumulated modes of the X and Y pols stacked in arrays of shape (2, n_mn)"""
+        pols = ['X', 'Y']
+        Q1 = np.array([self.beam_modes[pols[pol]]['Q1'] for pol in [0, 1]])
+        Q2 = np.array([self.beam_modes[pols[pol]]['Q2'] for pol in [0, 1]])
+        return (Q1, Q2)
+
+
+class BeamSet(object):
+    """Beams of one ApertureArray for many sets of delays and amplitudes (e.g. all the sweet
+    spots, see mwa_sweet_spots.get_all_delays), evaluated together on shared coordinates.
+
+    The accumulated modes of all the beams are calculated as one complex matrix product of the
+    excitation voltages (n_beams x n_ant) with the coefficients of the antennas (n_ant x n_modes)
+    for each pol, instead of one Beam object per set of delays, and the direction-dependent part
+    of the evaluation (DirectionBasis, HealpixBasis or InterpPlan) is only calculated once.
+
+    Usage:
+    (gridpoints, delays) = mwa_sweet_spots.get_all_delays()
+    beams = BeamSet(get_AA_Cached(150e6), delays)
+    jones = beams.get_response(az, za)    # shape (len(delays), 2, 2) + az.shape
+    """
+
+    def __init__(self, AA, delays, amps=None):
+        """
+        Input:
+        AA - ApertureArray object
+        delays - array of MWA beamformer delay steps of shape (n_beams, 2, 16), where the 2nd dimension is
+                 the antenna pol (NS, EW), or (n_beams, 16) to use the same delays for both pols.
+                 Dipoles with delay 32 are terminated (see Beam).
+        amps - array of antenna amplitudes of the same shape as delays, all 1 if None"""
+        self.AA = AA
+        delays = np.array(delays, dtype=np.float64)
+        if amps is None:
+            amps = np.ones(delays.shape)
+        else:
+            amps = np.array(amps, dtype=np.float64)
+        if (delays.ndim == 2) and (delays.shape[-1] == 16):
+            logger.warning('Assuming sets of 16 antenna delays apply to both X and Y dipoles')
+            delays = np.repeat(delays[:, None, :], 2, axis=1)
+        if (amps.ndim == 2) and (amps.shape[-1] == 16):
+            amps = np.repeat(amps[:, None, :], 2, axis=1)
+        if (delays.ndim != 3) or (delays.shape[1:] != (2, 16)):
+            e = 'Delays of shape %s are not shape (n_beams, 2, 16)' % (delays.shape,)
+            logger.error(e)
+            raise ValueError(e)
+        if amps.shape != delays.shape:
+            e = 'Amplitudes of shape %s do not match delays of shape %s' % (amps.shape, delays.shape)
+            logger.error(e)
+            raise ValueError(e)
+        if (delays > 32).any():
+            e = 'There are delays greater than 32: "%s"' % (delays[(delays > 32).any(axis=(1, 2))])
+            logger.error(e)
+            raise ValueError(e)
+
+        # check for terminated dipoles and reset delays and amps
+        terminated = delays == 32
+        if terminated.any():
+            logger.info('Terminated dipoles (delay setting 32) in %s beams... setting amplitude and delay to zero.' %
+                        terminated.any(axis=(1, 2)).sum())
+            delays[terminated] = 0
+            amps[terminated] = 0
+        self.delays = delays
+        self.amps = amps
+        self.calc_beam_modes()
+
+    def __len__(self):
+        return len(self.delays)
+
+    def calc_beam_modes(self):
+        """Calculate (accumulate) the modes of all the beams, Q_accum of shape (n_beams, 2, 2 * n_mn)
+        holding the Q1 followed by the Q2 coefficients for the X and Y pols"""
+        Vcplx = calc_excitations(self.AA.freq, self.delays, self.amps)    # shape (n_beams, 2, n_ant)
+        (Q, self.M, self.N) = self.AA.get_coefficients()
+        # for each pol, one (n_beams x n_ant) x (n_ant x 2 n_mn) matrix product
+        Q_accum = np.matmul(np.swapaxes(Vcplx, 0, 1), Q)
+        self.Q_accum = np.ascontiguousarray(np.swapaxes(Q_accum, 0, 1))
+
+    def get_nmax(self):
+        """Return the maximum degree n of the accumulated modes of the beams"""
+        return int(np.max(self.N))
+
+    def get_modes(self):
+        """Return (Q1, Q2), the accumulated modes of the X and Y pols of all the beams, shape (n_beams, 2, n_mn)"""
+        n_mn = len(self.M)
+        return (self.Q_accum[..., 0:n_mn], self.Q_accum[..., n_mn:])
+
+    def get_response(self, phi_arr, theta_arr, precision='double', max_memory_bytes=None):
+        """Return the Jones matrices of all the beams, shape (n_beams, 2, 2) + phi_arr.shape
+        (see Beam.get_response)
+
+        Input:
+        phi_arr - azimuth angles (radians), north through east.
+        theta_arr - zenith angles (radian), same shape as phi_arr
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis
+        max_memory_bytes - memory budget of the intermediate arrays (bytes), config.FF_CHUNK_MAX_BYTES if None"""
+        basis = DirectionBasis(phi_arr, theta_arr, self.get_nmax(), precision=precision)
+        return self.get_basis_jones(basis, max_memory_bytes)
+
+    def get_healpix_response(self, nside, basis=None, precision='double', max_memory_bytes=None):
+        """Return the Jones matrices of all the beams for the HEALPix pixels above the horizon,
+        shape (n_beams, 2, 2, basis.npix) (see Beam.get_healpix_response)"""
+        if basis is None:
+            basis = HealpixBasis(nside, self.get_nmax(), precision=precision)
+        return self.get_basis_jones(basis, max_memory_bytes)
+
+    def get_basis_jones(self, basis, max_memory_bytes=None):
+        """Return the Jones matrices of all the beams on a DirectionBasis or HealpixBasis,
+        shape (n_beams, 2, 2) + basis.shape. The beams are evaluated in groups, so that the
+        intermediate arrays of a group fit in max_memory_bytes (config.FF_CHUNK_MAX_BYTES if None)"""
+        if max_memory_bytes is None:
+            max_memory_bytes = config.FF_CHUNK_MAX_BYTES
+        (Q1, Q2) = self.get_modes()
+        bytes_per_beam = DirectionBasis.get_bytes_per_point_beam(basis.nmax, basis.precision) * max(1, np.prod(basis.shape))
+        n_group = int(max(1, max_memory_bytes // bytes_per_beam))
+        Jones = np.empty((len(self), 2, 2) + tuple(basis.shape), dtype=basis.dtype)
+        for start in range(0, len(self), n_group):
+            Jones[start:start + n_group] = basis.get_jones(Q1[start:start + n_group], Q2[start:start + n_group])
+        return Jones
+
+    def get_interp_response(self, phi_arr, theta_arr, pixels_per_deg=5, plan=None, precision='double'):
+        """Return the Jones matrices of all the beams interpolated from gridded beams,
+        shape (n_beams, 2, 2) + phi_arr.shape (see Beam.get_interp_response). The grid basis and the
+        interpolation plan are shared by all the beams, which are gridded one at a time."""
+        if plan is None:
+            plan = InterpPlan(phi_arr, theta_arr, pixels_per_deg)
+        basis = DirectionBasis(plan.phi_1D, plan.theta_1D, self.get_nmax(), grid=True, precision=precision)
+        (Q1, Q2) = self.get_modes()
+        Jones = np.empty((len(self), 2, 2) + tuple(plan.shape), dtype=basis.dtype)
+        for i in range(len(self)):
+            Jones[i] = plan.interpolate(basis.get_jones(Q1[i], Q2[i]))
+        return Jones
+
+    def apply_zenith_norm_Jones(self, j):
+        """Apply the zenith normalisation factor of the ApertureArray to Jones matrices of shape (n_beams, 2, 2, ...)"""
+        return np.moveaxis(self.AA.apply_zenith_norm_Jones(np.moveaxis(j, 0, -1)), -1, 0)
+
+
+class TileBeams(object):
+    """Beams of all the tiles of an array, where tiles differ by their flagged (amplitude 0) or
+    terminated (delay 32) dipoles, or even by their delays.
+
+    Each tile is reduced to a canonical configuration (terminated dipoles and dipoles of
+    amplitude 0 have delay and amplitude 0), and each distinct configuration is only evaluated
+    once, as a BeamSet on shared coordinates. Typically the 128 tiles of an observation only have
+    a handful of distinct configurations. The Jones matrices of each tile are views into those
+    of its configuration, so no memory is duplicated.
+
+    Usage:
+    tiles = TileBeams(get_AA_Cached(150e6), delays, amps)    # both of shape (n_tiles, 2, 16)
+    jones = tiles.get_response(az, za)     # list of n_tiles arrays of shape (2, 2) + az.shape
+    """
+
+    def __init__(self, AA, delays, amps=None):
+        """
+        Input:
+        AA - ApertureArray object
+        delays - array of MWA beamformer delay steps of shape (n_tiles, 2, 16), or of shape (2, 16) if all the tiles
+                 have the same delays. Dipoles with delay 32 are terminated (see Beam).
+        amps - array of antenna amplitudes of shape (n_tiles, 2, 16), or (2, 16), all 1 if None"""
+        delays = np.asarray(delays, dtype=np.float64)
+        if amps is None:
+            amps = np.ones(delays.shape)
+        try:
+            (delays, amps) = np.broadcast_arrays(delays, np.asarray(amps, dtype=np.float64))
+        except ValueError:
+            e = 'Delays of shape %s and amplitudes of shape %s do not match' % (np.shape(delays), np.shape(amps))
+            logger.error(e)
+            raise ValueError(e)
+        if (delays.ndim != 3) or (delays.shape[1:] != (2, 16)):
+            e = 'Delays and amplitudes of shape %s are not shape (n_tiles, 2, 16)' % (delays.shape,)
+            logger.error(e)
+            raise ValueError(e)
+
+        # canonical configurations: the delay of a dipole which does not contribute does not matter
+        delays = np.array(delays)
+        amps = np.array(amps)
+        off = (delays == 32) | (amps == 0)
+        delays[off] = 0
+        amps[off] = 0
+
+        # the tiles with the same configuration (delays and amplitudes) share one beam
+        configs = np.concatenate([delays, amps], axis=1).reshape((len(delays), -1))
+        (unique, first, tile_index) = np.unique(configs, axis=0, return_index=True, return_inverse=True)
+        self.tile_index = np.asarray(tile_index).reshape(-1)
+        logger.info('%s tiles have %s distinct beams' % (len(delays), len(unique)))
+        self.beams = BeamSet(AA, delays[first], amps[first])
+        self.AA = AA
+
+    def __len__(self):
+        return len(self.tile_index)
+
+    def get_unique_response(self, phi_arr, theta_arr, interp=False, pixels_per_deg=5, plan=None,
+                            precision='double', zenithnorm=False):
+        """Return the Jones matrices of the distinct beams, shape (n_beams, 2, 2) + phi_arr.shape,
+        where tile i has the beam tile_index[i]
+
+        Input:
+        phi_arr - azimuth angles (radians), north through east.
+        theta_arr - zenith angles (radian), same shape as phi_arr
+        interp - if True, interpolate the beams from gridded beams (see Beam.get_interp_response)
+        pixels_per_deg, plan - see Beam.get_interp_response, only used if interp is True
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis
+        zenithnorm - apply the zenith normalisation of the ApertureArray"""
+        if interp:
+            Jones = self.beams.get_interp_response(phi_arr, theta_arr, pixels_per_deg, plan=plan, precision=precision)
+        else:
+            Jones = self.beams.get_response(phi_arr, theta_arr, precision=precision)
+        if zenithnorm:
+            Jones = self.beams.apply_zenith_norm_Jones(Jones)
+        return Jones
+
+    def get_response(self, phi_arr, theta_arr, interp=False, pixels_per_deg=5, plan=None,
+                     precision='double', zenithnorm=False):
+        """Return a list of the Jones matrices of each tile, arrays of shape (2, 2) + phi_arr.shape
+        which are views into the Jones matrices of the distinct beams (see get_unique_response)"""
+        Jones = self.get_unique_response(phi_arr, theta_arr, interp=interp, pixels_per_deg=pixels_per_deg,
+                                         plan=plan, precision=precision, zenithnorm=zenithnorm)
+        return self.get_tile_views(Jones)
+
+    def get_tile_views(self, unique):
+        """Return a list of the views of each tile into unique, an array of shape (n_beams, ...) of a
+        quantity of the distinct beams (e.g. the result of get_unique_response)"""
+        return [unique[i] for i in self.tile_index]
+
+
+class IncrementalBeam(object):
+    """Jones matrices of a beam on a set of coordinates which can be updated cheaply when the
+    delay or amplitude of a single dipole changes, e.g. for dead dipole diagnostics or
+    beamformer fault searches iterating over the 32 dipoles.
+
+    The accumulated modes, and so the Jones matrices, are linear in the complex excitation
+    voltages of the antennas. The Jones matrices of each antenna with a unit excitation are
+    calculated once (16 x 2 x 2 per point), and changing the excitation of one dipole then only
+    adds the change of its voltage times its own contribution, which is O(number of points).
+
+    Usage:
+    ib = IncrementalBeam(AA, az, za, delays)
+    for ant in range(16):
+        jones = ib.get_variant(0, ant, amp=0)    # X dipole ant dead, shape (2, 2) + az.shape
+    ib.update(1, 3, delay=32)                   # terminate Y dipole 3, ib.jones is updated
+    """
+
+    def __init__(self, AA, phi_arr=None, theta_arr=None, delays=None, amps=None, basis=None, precision='double'):
+        """
+        Input:
+        AA - ApertureArray object
+        phi_arr - azimuth angles (radians), north through east
+        theta_arr - zenith angles (radians), same shape as phi_arr
+        delays - MWA beamformer delay steps of shape (2, 16) (or (16,) for both pols), 0 if None.
+                 Delay 32 terminates a dipole (see Beam).
+        amps - antenna amplitudes of shape (2, 16) (or (16,) for both pols), 1 if None
+        basis - optional DirectionBasis or HealpixBasis for the coordinates (phi_arr, theta_arr and
+                precision are then ignored), e.g. for a grid
+        precision - 'double' (complex128) or 'single' (complex64), see DirectionBasis"""
+        self.AA = AA
+        (Q, M, N) = AA.get_coefficients()
+        if basis is None:
+            basis = DirectionBasis(phi_arr, theta_arr, int(np.max(N)), precision=precision)
+        self.shape = tuple(basis.shape)
+        n_mn = len(M)
+        # Jones matrices of each antenna for a unit excitation, shape (n_ant, 2, 2) + shape
+        Q_ant = np.swapaxes(Q, 0, 1)
+        self.element_jones = basis.get_jones(Q_ant[..., 0:n_mn], Q_ant[..., n_mn:])
+
+        self.delays = np.zeros((2, 16))
+        self.amps = np.ones((2, 16))
+        if delays is not None:
+            self.delays[...] = delays
+        if amps is not None:
+            self.amps[...] = amps
+        (self.delays, self.amps) = self._terminate(self.delays, self.amps)
+        self.recalc()
+
+    @staticmethod
+    def _terminate(delays, amps):
+        """Set the delays and amplitudes of terminated dipoles (delay setting 32) to zero"""
+        if (np.asarray(delays) > 32).any():
+            e = 'There are delays greater than 32: "%s"' % (delays)
+            logger.error(e)
+            raise ValueError(e)
+        terminated = np.asarray(delays) == 32
+        delays = np.where(terminated, 0, delays)
+        amps = np.where(terminated, 0, amps)
+        return (delays, amps)
+
+    def get_excitations(self):
+        """Return the complex excitation voltages of the antennas, shape (2, n_ant)"""
+        return calc_excitations(self.AA.freq, self.delays, self.amps)
+
+    def recalc(self):
+        """Recalculate the Jones matrices from the contributions of all the antennas
+        (e.g. to remove the rounding errors accumulated over many updates)"""
+        Vcplx = self.get_excitations().astype(self.element_jones.dtype)
+        self.jones = np.empty((2, 2) + self.shape, dtype=self.element_jones.dtype)
+        for pol in [0, 1]:
+            self.jones[pol] = np.tensordot(Vcplx[pol], self.element_jones[:, pol], axes=(0, 0))
+        return self.jones
+
+    def _get_delta(self, pol, ant, delay=None, amp=None):
+        """Return (delay, amp, change of the Jones matrices of pol) for a new delay and/or amplitude of dipole ant of pol"""
+        if delay is None:
+            delay = self.delays[pol, ant]
+        if amp is None:
+            amp = self.amps[pol, ant]
+        (delay, amp) = self._terminate(delay, amp)
+        (V_old, V_new) = calc_excitations(self.AA.freq, np.array([self.delays[pol, ant], delay]),
+                                          np.array([self.amps[pol, ant], amp]))
+        return (delay, amp, (V_new - V_old) * self.element_jones[ant, pol])
+
+    def get_variant(self, pol, ant, delay=None, amp=None):
+        """Return the Jones matrices, shape (2, 2) + shape of the coordinates, of the beam with the delay and/or
+        amplitude of dipole ant of pol (0 for X, 1 for Y) changed, without changing this beam
+
+        Input:
+        pol - 0 for the X (NS) dipoles, 1 for the Y (EW) dipoles
+        ant - antenna number (0-15)
+        delay - new delay step, unchanged if None (32 terminates the dipole)
+        amp - new amplitude, unchanged if None"""
+        (delay, amp, delta) = self._get_delta(pol, ant, delay, amp)
+        jones = self.jones.copy()
+        jones[pol] += delta
+        return jones
+
+    def update(self, pol, ant, delay=None, amp=None):
+        """Change the delay and/or amplitude of dipole ant of pol (see get_variant), updating the Jones
+        matrices of this beam in place, and return them"""
+        (delay, amp, delta) = self._get_delta(pol, ant, delay, amp)
+        self.jones[pol] += delta
+        self.delays[pol, ant] = delay
+        self.amps[pol, ant] = amp
+        return self.jones
+
+    def get_nbytes(self):
+        """Return the memory used by the contributions of the antennas and the Jones matrices (bytes)"""
+        return self.element_jones.nbytes + self.jones.nbytes
+
+
+def calc_excitations(freq, delays, amps):
+    """Return the complex excitation voltages of the antennas for beamformer delay steps delays and
+    amplitudes amps (arrays of the same shape, e.g. (2, n_ant)) at frequency freq (Hz)"""
+    phases = 2 * math.pi * freq * (-delays) * 435e-12  # convert delay to phase
+    return amps * np.exp(1.0j * phases)  # complex excitation col voltage
+
+
+def get_mode_vectors(nmax):
+    """Return M, N vectors in FEKO order (see Beam) for all modes up to degree nmax"""
+    M = np.concatenate([np.arange(-n, n + 1) for n in range(1, nmax + 1)]).astype(np.float64)
+    N = np.concatenate([np.repeat(n, 2 * n + 1) for n in range(1, nmax + 1)]).astype(np.float64)
+    return (M, N)
+
+
+class DirectionBasis(object):
+    """Direction-dependent part of the spherical harmonics expansion of a beam for a set of
+    spherical coordinates.
+
+    The Legendre terms, the normalisation constants and the phi-dependent components of the
+    far field only depend on the coordinates and the maximum degree of the modes, not on
+    the accumulated Q1/Q2 coefficients (which carry frequency, delays and amplitudes).
+    A DirectionBasis is calculated once and can then be used to evaluate the Jones
+    matrices of any number of beams (e.g. several pointings or frequencies) on the same
+    coordinates, as a batched contraction of their coefficients against the basis.
+
+    Usage:
+    basis = DirectionBasis(az, za, nmax=max([b.get_nmax() for b in beams]))
+    jones = basis.get_beams_jones(beams)    # shape (len(beams), 2, 2) + az.shape
+
+    With precision='single' the basis, the contraction with the coefficients and the resulting
+    Jones matrices are complex64, which halves the memory and bandwidth of large beams.
+    The Legendre functions and the phi terms are still calculated in double precision and
+    only then rounded. The absolute error of the Jones matrices is then less than 1e-6 times
+    the maximum of |J| for nmax up to 12 (measured maximum 3e-7 over the whole sky),
+    i.e. far below the accuracy of the model itself.
+    """
+
+    def __init__(self, phi_arr, theta_arr, nmax, grid=False, precision='double', verbose=True, phi_fft=None):
+        """
+        Input:
+        phi_arr - Array of azimuth angles (radians), north through east
+        theta_arr - Array of zenith angles (radians)
+        nmax - maximum degree n of the modes of the beams to be evaluated
+        grid - If True, phi_arr and theta_arr are 1-D axes of a grid of shape (n_phi, n_theta).
+               If False, they are arrays of equal shape defining the points.
+        precision - 'double' (complex128) or 'single' (complex64) evaluation
+        verbose - if False, do not warn about large numbers of points (e.g. for chunks of a larger set)
+        phi_fft - for a grid, whether to do the sum over m with an FFT along phi (see get_phi_fft_len):
+                  None to choose automatically, True to use it whenever the phi axis allows it, False never
+        """
+        if precision not in PRECISIONS:
+            e = 'Precision %s not supported' % precision
+            logger.error(e)
+            raise ValueError(e)
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        phi_arr = np.array(phi_arr, dtype=np.float64, ndmin=1)
+        theta_arr = np.array(theta_arr, dtype=np.float64, ndmin=1)
         if grid:
             # Create 4-D Jones matrix of shape: 2 x 2 x n_phi x n_theta
             if phi_arr.ndim != 1 and theta_arr.ndim != 1:
                 e = 'For gridded beam, theta (shape %s) and phi (shape %s) must be 1-D arrays'
                 logger.error(e % (np.shape(theta_arr), np.shape(phi_arr)))
                 raise ValueError(e % (np.shape(theta_arr), np.shape(phi_arr)))
-            Jones = np.zeros((2, 2, len(phi_arr), len(theta_arr)), dtype=np.complex128)
+            self.shape = (len(phi_arr), len(theta_arr))
         else:
             # Create Jones matrix of shape: 2 x 2 x shape(phi_arr)
             if phi_arr.shape != theta_arr.shape:
                 e = 'Theta (shape %s) and phi (shape %s) must be the same shape'
                 logger.error(e % (np.shape(theta_arr), np.shape(phi_arr)))
                 raise ValueError(e % (np.shape(theta_arr), np.shape(phi_arr)))
-            Jones = np.zeros((2, 2) + np.shape(phi_arr), dtype=np.complex128)
+            self.shape = np.shape(phi_arr)
+        self.grid = grid
+        self.nmax = nmax
 
         counter = 10000  # Counter for messages
+        if verbose and (phi_arr.size > counter):
+            logger.debug('Time is %s' % datetime.datetime.now().time())
+            logger.warning('Calculating for %s points. This may take a while!' % phi_arr.size)
+
+        # an FFT can replace the product with phi_comp for a uniform phi axis covering the circle
+        # in an integer number of steps
+        self.fft_len = None
+        if grid and (phi_fft is not False):
+            self.fft_len = get_phi_fft_len(phi_arr)
+            if (self.fft_len is not None) and (phi_fft is None):
+                fft_cost = FFT_COST_FACTOR * self.fft_len * math.log(self.fft_len, 2)
+                if fft_cost > len(phi_arr) * (2 * nmax + 1):
+                    self.fft_len = None
+        if self.fft_len is not None:
+            logger.debug('Using FFT of length %s along phi' % self.fft_len)
+            # Sigma[p] = sum_m emn_sum[m] * exp(1j * m * (pi/2 - phi_0)) * exp(-2j * pi * m * p / fft_len)
+            m = np.arange(-nmax, nmax + 1)
+            self.fft_phase = np.exp(1.0j * m * (math.pi / 2 - phi_arr[0])).astype(self.dtype)
+            self.fft_m_index = np.mod(m, self.fft_len)
+            self.fft_phi_index = np.mod(np.arange(len(phi_arr)), self.fft_len)
 
         phi_arr = math.pi / 2 - phi_arr  # Convert to East through North (FEKO coords)
         phi_arr[phi_arr < 0] += 2 * math.pi  # 360 wrap
 
-        pols = ['X', 'Y']
-        for pol in [0, 1]:
-            # Extract modes for this pol
-            M = self.beam_modes[pols[pol]]['M']
-            N = self.beam_modes[pols[pol]]['N']
-            Q1 = self.beam_modes[pols[pol]]['Q1']
-            Q2 = self.beam_modes[pols[pol]]['Q2']
-
-            # form P(cos\theta)/(sin\theta) and P^{m+1}(cos\theta)with FEKO M,N order
-            nmax = int(np.max(N))
-            if np.max(N) - nmax != 0:
-                logger.error('The maximum of N should be an integer value!')
-
-            # form pre-multiplying constants in (1) of "Calculating...."
-            # Rick 19-12-2016: this is fine for the amount of modes used for the MWA simulations
-            # but the factorials explode for higher number of modes!
-            C_MN = (0.5 * (2 * N + 1) * factorial(N - abs(M)) / factorial(N + abs(M))) ** 0.5
-            # Rick 19-12-2016: remove annoying "RuntimeWarning: invalid value encountered in divide, MabsM=-M/np.abs(M) ", caused by:
-            # MabsM=-M/np.abs(M)  <----
-            # MabsM[MabsM==np.NaN]=1 #for M=0, replace NaN with MabsM=1;
-            # MabsM=(MabsM)**M
-            # this does the same trick: 1 for M<=0, -1 for odd M>0
-            MabsM = np.ones(M.shape)
-            MabsM[(M > 0) & (M % 2 != 0)] = -1
-
-            if len(phi_arr.ravel()) > counter:
-                logger.debug('Time is %s' % datetime.datetime.now().time())
-                logger.warning('Calculating for %s points. This may take a while!' % len(phi_arr.ravel()))
-
-            # determine unique thetas, phis to speed up calculations
-            # also store the indices of the unique phi/theta components
-            if not grid:
-                phi_unique, phi_index = np.unique(phi_arr, return_inverse=True)
-                theta_unique, theta_index = np.unique(theta_arr, return_inverse=True)  # speeds up calculations
-            else:  # We expect all to be unique
-                phi_unique, phi_index = phi_arr, None
-                theta_unique, theta_index = theta_arr, None
-
-            # Rick 16-3-2017
-            # calculate phi-dependent component ( phi_comp ), but only for each unique M  (!!)
-            # make sure data is stored as a contiguous array	to reduce cache misses
-            # (should be the case automatically, but just to be sure)
-            phi_comp = np.ascontiguousarray(np.exp(1.0j * np.outer(phi_unique, list(range(-nmax, nmax + 1)))))
-            # determine theta-dependent components
-            # nomenclature:
-            # T and P are the sky polarisations theta and phi
-            # theta and phi are direction coordinates
-
-            (P_sin, P1) = P1sin_array(nmax, theta_unique)
-            M_u = np.outer(np.cos(theta_unique), np.abs(M))
-            phi_const = C_MN * MabsM / (N * (N + 1)) ** 0.5
-            emn_T = (1.0j) ** N * (P_sin * (M_u * Q2 - M * Q1) + Q2 * P1) * phi_const
-            emn_P = (1.0j) ** (N + 1) * (P_sin * (M * Q2 - Q1 * M_u) - Q1 * P1) * phi_const
-
-            # Rick 19-12-2016: Use a matrix multiplication to calculate Emn_P and Emn_T.
-            # Sum results of Emn_P and emn_T for each unique M
-            # this will make the matrix multiplication much faster, especially for
-            # really fine grids (dimension reduces from [nmax^2+2*nmax] to [2*nmax+1] )
-            # tests showed that the overhead for summing and re-calculating phi
-            # is smaller than doing the dot product without reductions (especially for fine grids)
-            emn_P_sum = np.zeros((len(theta_unique), 2 * nmax + 1), dtype=np.complex128)
-            emn_T_sum = np.zeros((len(theta_unique), 2 * nmax + 1), dtype=np.complex128)
-            for m in range(-nmax, nmax + 1):
-                emn_P_sum[:, m + nmax] = np.sum(emn_P[:, M == m], axis=1)
-                emn_T_sum[:, m + nmax] = np.sum(emn_T[:, M == m], axis=1)
-
-            if grid:  # Calculate via gridded approach
-                # the actual calculation using dot product
-                Sigma_P = np.inner(phi_comp, emn_P_sum)
-                Sigma_T = np.inner(phi_comp, emn_T_sum)
-                # print('calculate sigma done...%s'%datetime.datetime.now().time())
-            else:  # Calculate for every value in theta,phi. could probably be vectorised too
-                # determine whether it's more worth it to do a dot product for
-                # each unique theta/phi combination (creates a 2D array of (len(theta_unique),len(phi_unique))
-                # OR do a prodoct/sum of 2 arrays of (len(phi_arr) * (2*nmax+1))
-                if (len(phi_unique) * len(phi_unique)) < (len(phi_arr.ravel()) * (nmax * 2 + 1)):
-                    # calculate using an inner product and selecting the desired coordinates afterwards
-                    # benificial for a low number of unique (theta,phi) coordinates, e.g. on a (semi) regular grid
-                    Sigma_P_comp = np.inner(phi_comp, emn_P_sum)
-                    Sigma_T_comp = np.inner(phi_comp, emn_T_sum)
-                    Sigma_P = Sigma_P_comp[phi_index, theta_index].reshape(np.shape(phi_arr))
-                    Sigma_T = Sigma_T_comp[phi_index, theta_index].reshape(np.shape(phi_arr))
-                else:
-                    # calculate by copying correct sections of data and doing a multiply/sum afterwards
-                    # benificial in the case of many unique (theta,phi) coordinates, e.g. on a random grid
-                    # construct 3 arrays of dimension (len(phi_arr),2*nmax+1)
-                    emn_P_2 = emn_P_sum[theta_index, :]
-                    emn_T_2 = emn_T_sum[theta_index, :]
-                    phi_comp_2 = phi_comp[phi_index, :]
-                    # print('preparing done, calculating sigma (ungridded, sum)...%s'%datetime.datetime.now().time())
-                    # the calculation involves multiplying and summing each column
-                    # the result is
-                    Sigma_T = np.sum(emn_T_2 * phi_comp_2, axis=1).reshape(np.shape(phi_arr))
-                    Sigma_P = np.sum(emn_P_2 * phi_comp_2, axis=1).reshape(np.shape(phi_arr))
-
-            # to match with FEKO (neglects: exp(jbeta r)/r factor)
-            logger.debug('Done... %s' % datetime.datetime.now().time())
-
-            #    mu0=4*math.pi*1e-7
-            #    eps0=8.85418781761e-12
-            #    Zo=(mu0/eps0)**0.5
-            #    sqrt_fac=(Zo/(2*math.pi))**0.5
-            #
-            #    E_P=sqrt_fac*Sigma_P
-            #    E_T=sqrt_fac*Sigma_T
-
-            # Save for this polarisation
-            Jones[pol, 0] = Sigma_T
-            Jones[pol, 1] = -Sigma_P  # 2017-05-30 : sign fixed by MS to reflect the fact that phi=90-az (it is not just change of values but orientation of base vector changes,
-            # hence the sign of the Phi component of electric field has to change too. It was also fixed
-
-#       multiple by XY phase :
-        xy_phase_rad = config.xy_phase_deg*(math.pi/180.00)
-        xy_phase = math.cos(xy_phase_rad) + 1j*math.sin(xy_phase_rad)
-        # modify Jones in X polarisation (i.e. first index 0) only:
-        Jones[0, 0] = Jones[0, 0]*xy_phase
-        Jones[0, 1] = Jones[0, 1]*xy_phase
-        print("DEBUG : xy_phase = %.6f [rad], xy_phase = %s" % (xy_phase_rad,xy_phase))
+        # determine unique thetas, phis to speed up calculations
+        # also store the indices of the unique phi/theta components
+        if not grid:
+            phi_unique, self.phi_index = np.unique(phi_arr.ravel(), return_inverse=True)
+            theta_unique, self.theta_index = np.unique(theta_arr.ravel(), return_inverse=True)  # speeds up calculations
+        else:  # We expect all to be unique
+            phi_unique, self.phi_index = phi_arr, None
+            theta_unique, self.theta_index = theta_arr, None
+
+        # Rick 16-3-2017
+        # calculate phi-dependent component ( phi_comp ), but only for each unique M  (!!)
+        # make sure data is stored as a contiguous array	to reduce cache misses
+        # (should be the case automatically, but just to be sure)
+        if self.fft_len is None:
+            self.phi_comp = np.ascontiguousarray(np.exp(1.0j * np.outer(phi_unique, list(range(-nmax, nmax + 1)))),
+                                                 dtype=self.dtype)
+        else:
+            self.phi_comp = None
+
+        # determine whether it's more worth it to do a dot product for
+        # each unique theta/phi combination (creates a 2D array of (len(theta_unique),len(phi_unique))
+        # OR do a prodoct/sum of 2 arrays of (len(phi_arr) * (2*nmax+1))
+        self.use_inner = grid or ((len(phi_unique) * len(theta_unique)) < (phi_arr.size * (nmax * 2 + 1)))
+
+        # determine theta-dependent components
+        # nomenclature:
+        # T and P are the sky polarisations theta and phi
+        # theta and phi are direction coordinates
+        (M, N) = get_mode_vectors(nmax)
+
+        # this does the same trick as MabsM=(-M/np.abs(M))**M: 1 for M<=0, -1 for odd M>0
+        MabsM = np.ones(M.shape)
+        MabsM[(M > 0) & (M % 2 != 0)] = -1
+
+        # the pre-multiplying constants C_MN in (1) of "Calculating...." are included in the
+        # normalised Legendre functions (instead of factorials, which explode for higher number of modes)
+        (P_sin, P1) = P1sin_norm_array(nmax, theta_unique)
+        M_u = np.outer(np.cos(theta_unique), np.abs(M))
+        phi_const = MabsM / (N * (N + 1)) ** 0.5
+
+        # emn_T = (1j)**N * (P_sin * (M_u * Q2 - M * Q1) + Q2 * P1) * phi_const
+        # emn_P = (1j)**(N+1) * (P_sin * (M * Q2 - Q1 * M_u) - Q1 * P1) * phi_const
+        # are linear in Q1, Q2 so can be written as emn_T = B * Q2 - A * Q1 and emn_P = 1j * (A * Q2 - B * Q1)
+        # The modes are stored sorted by M, so that the sum over each unique M
+        # (which reduces the dimension from [nmax^2+2*nmax] to [2*nmax+1]) is a matrix product
+        # over contiguous columns
+        self.m_order = np.argsort(M, kind='mergesort')
+        self.m_starts = np.searchsorted(M[self.m_order], np.arange(-nmax, nmax + 1))
+        A = (1.0j) ** N * P_sin * M * phi_const
+        B = (1.0j) ** N * (P_sin * M_u + P1) * phi_const
+        self.A = np.ascontiguousarray(A[:, self.m_order], dtype=self.dtype)
+        self.B = np.ascontiguousarray(B[:, self.m_order], dtype=self.dtype)
+
+    @staticmethod
+    def get_bytes_per_point(nmax, precision='double'):
+        """Return an upper estimate of the memory (bytes) used per point (not on a grid) by
+        the basis and by get_jones for one beam, i.e. the Legendre terms, A and B, and the sums
+        over the modes of each m"""
+        n_mn = nmax ** 2 + 2 * nmax
+        itemsize = np.dtype(PRECISIONS[precision]).itemsize
+        # P_sin, P1, M_u (float64) and A, B in double precision while they are calculated, A and B,
+        # and get_bytes_per_beam_point for the sums over m, phi_comp and the Jones matrices
+        return 3 * 8 * n_mn + 2 * 16 * n_mn + 2 * itemsize * n_mn + DirectionBasis.get_bytes_per_point_beam(nmax, precision)
+
+    @staticmethod
+    def get_bytes_per_point_beam(nmax, precision='double'):
+        """Return an upper estimate of the memory (bytes) used by get_jones per point and per beam, i.e.
+        the sums over m of 2 pols x 2 fields (and their reordered copies), phi_comp and the Jones matrices"""
+        itemsize = np.dtype(PRECISIONS[precision]).itemsize
+        return (9 * (2 * nmax + 1) + 4) * itemsize
+
+    def _phi_fft(self, emn_sum):
+        """Return the sum over m of emn_sum (..., n_theta, 2*nmax+1) times phi_comp for a uniform phi axis,
+        shape (..., n_phi, n_theta), as an FFT of length fft_len along phi for each theta"""
+        C = np.zeros(emn_sum.shape[:-1] + (self.fft_len,), dtype=self.dtype)
+        if self.fft_len >= len(self.fft_m_index):
+            C[..., self.fft_m_index] = emn_sum * self.fft_phase
+        else:  # fewer phi steps around the circle than m values, the m values alias
+            np.add.at(C, (Ellipsis, self.fft_m_index), emn_sum * self.fft_phase)
+        Sigma = np.fft.fft(C, axis=-1).astype(self.dtype, copy=False)
+        return np.swapaxes(Sigma[..., self.fft_phi_index], -1, -2)
+
+    def get_emn_sums(self, Q1, Q2):
+        """Return (emn_T_sum, emn_P_sum), the theta-dependent terms of the theta and phi polarised
+        fields summed for each m=-nmax..nmax, for one or more sets of accumulated coefficients Q1, Q2
+        of shape (..., n_mn), with shape Q1.shape[:-1] + (n_theta_unique, 2*nmax+1).
+        n_mn can be smaller than that of the basis (i.e. modes of a lower degree)."""
+        n_mn = self.nmax ** 2 + 2 * self.nmax
+        if Q1.shape[-1] > n_mn:
+            e = 'Coefficients with %s modes cannot be evaluated on a basis with nmax=%s'
+            logger.error(e % (Q1.shape[-1], self.nmax))
+            raise ValueError(e % (Q1.shape[-1], self.nmax))
+        pad = [(0, 0)] * (Q1.ndim - 1) + [(0, n_mn - Q1.shape[-1])]
+        Q1 = np.pad(np.asarray(Q1, dtype=self.dtype), pad, 'constant')[..., self.m_order]
+        Q2 = np.pad(np.asarray(Q2, dtype=self.dtype), pad, 'constant')[..., self.m_order]
+
+        # the sum over the modes of each m is a matrix product (n_theta x n_modes of m) x (n_modes of m x n_sets)
+        # for all the sets of coefficients (e.g. both pols of many beams) at once
+        lead = Q1.shape[:-1]
+        n_sets = int(np.prod(lead))
+        Q1 = Q1.reshape((n_sets, n_mn)).T
+        Q2 = Q2.reshape((n_sets, n_mn)).T
+        n_theta = self.A.shape[0]
+        emn_T_sum = np.empty((n_theta, 2 * self.nmax + 1, n_sets), dtype=self.dtype)
+        emn_P_sum = np.empty((n_theta, 2 * self.nmax + 1, n_sets), dtype=self.dtype)
+        stops = np.append(self.m_starts[1:], n_mn)
+        for (i, (start, stop)) in enumerate(zip(self.m_starts, stops)):
+            (A, B) = (self.A[:, start:stop], self.B[:, start:stop])
+            (Q1_m, Q2_m) = (Q1[start:stop], Q2[start:stop])
+            emn_T_sum[:, i] = np.dot(B, Q2_m) - np.dot(A, Q1_m)
+            emn_P_sum[:, i] = 1.0j * (np.dot(A, Q2_m) - np.dot(B, Q1_m))
+        emn_T_sum = np.moveaxis(emn_T_sum, -1, 0).reshape(lead + (n_theta, 2 * self.nmax + 1))
+        emn_P_sum = np.moveaxis(emn_P_sum, -1, 0).reshape(lead + (n_theta, 2 * self.nmax + 1))
+        return (emn_T_sum, emn_P_sum)
+
+    def get_sigma(self, Q1, Q2):
+        """Return (Sigma_T, Sigma_P), the theta and phi polarised fields for one or more
+        sets of accumulated coefficients Q1, Q2 of shape (..., n_mn). n_mn can be smaller
+        than that of the basis (i.e. modes of a lower degree), and the result has shape
+        Q1.shape[:-1] + shape of the coordinates (n_phi, n_theta for a grid)"""
+        (emn_T_sum, emn_P_sum) = self.get_emn_sums(Q1, Q2)
+
+        lead = np.shape(Q1)[:-1]
+        if self.grid and (self.fft_len is not None):  # gridded, with FFT along a uniform phi axis
+            Sigma_T = self._phi_fft(emn_T_sum)
+            Sigma_P = self._phi_fft(emn_P_sum)
+        elif self.grid:  # Calculate via gridded approach
+            # the actual calculation using dot product
+            Sigma_T = np.matmul(self.phi_comp, np.swapaxes(emn_T_sum, -1, -2))
+            Sigma_P = np.matmul(self.phi_comp, np.swapaxes(emn_P_sum, -1, -2))
+        elif self.use_inner:
+            # calculate using an inner product and selecting the desired coordinates afterwards
+            # benificial for a low number of unique (theta,phi) coordinates, e.g. on a (semi) regular grid
+            Sigma_T_comp = np.matmul(self.phi_comp, np.swapaxes(emn_T_sum, -1, -2))
+            Sigma_P_comp = np.matmul(self.phi_comp, np.swapaxes(emn_P_sum, -1, -2))
+            Sigma_T = Sigma_T_comp[..., self.phi_index, self.theta_index].reshape(lead + self.shape)
+            Sigma_P = Sigma_P_comp[..., self.phi_index, self.theta_index].reshape(lead + self.shape)
+        else:
+            # calculate by copying correct sections of data and doing a multiply/sum afterwards
+            # benificial in the case of many unique (theta,phi) coordinates, e.g. on a random grid
+            phi_comp_2 = self.phi_comp[self.phi_index, :]
+            Sigma_T = np.sum(emn_T_sum[..., self.theta_index, :] * phi_comp_2, axis=-1).reshape(lead + self.shape)
+            Sigma_P = np.sum(emn_P_sum[..., self.theta_index, :] * phi_comp_2, axis=-1).reshape(lead + self.shape)
+        return (Sigma_T, Sigma_P)
 
-        return Jones
+    def get_jones(self, Q1, Q2):
+        """Return the Jones matrices for one or more beams given their accumulated modes
+        Q1, Q2 of shape (..., 2, n_mn), where the 2 is the X and Y pol.
 
+        Output:
+        Jones - array of shape Q1.shape[:-2] + (2, 2) + shape of the coordinates, where
+        [J_11=Xtheta J_12=Xphi]
+        [J_21=Ytheta J_21=Yphi]
+        """
+        (Sigma_T, Sigma_P) = self.get_sigma(Q1, Q2)
+        return sigma_to_jones(Sigma_T, Sigma_P, len(self.shape))
+
+    def get_beams_jones(self, beams):
+        """Return the Jones matrices of a list of Beam objects, shape (len(beams), 2, 2) + shape of the coordinates"""
+        n_mn = self.nmax ** 2 + 2 * self.nmax
+        Q1 = np.zeros((len(beams), 2, n_mn), dtype=np.complex128)
+        Q2 = np.zeros((len(beams), 2, n_mn), dtype=np.complex128)
+        for i, beam in enumerate(beams):
+            (Q1_b, Q2_b) = beam.get_modes()
+            Q1[i, :, 0:Q1_b.shape[-1]] = Q1_b
+            Q2[i, :, 0:Q2_b.shape[-1]] = Q2_b
+        return self.get_jones(Q1, Q2)
+
+
+class HealpixBasis(object):
+    """Direction-dependent part of the spherical harmonics expansion of a beam for the pixels
+    of a HEALPix map (RING ordering) above the horizon, where the pole of the map is the zenith
+    (see beam_tools.get_healpix_rings), i.e. the first 2*nside*(3*nside+1) pixels of the map.
+
+    The pixels lie on 2*nside iso-latitude rings of equally spaced pixels, so the Legendre terms
+    are only calculated once per ring (a DirectionBasis of the ring ZAs), and the sum over m
+    of each ring is an FFT of the length of the ring. Rings of the same length (all those of
+    the equatorial belt) are transformed together.
+
+    The pixels have equal areas, so integrals over the sky (e.g. beam solid angle or antenna
+    temperature) are sums over the pixels weighted by weights, 4*pi/npix for all pixels except
+    those on the horizon, which only count half.
+
+    Usage:
+    basis = HealpixBasis(nside=64, nmax=beam.get_nmax())
+    jones = basis.get_jones(Q1, Q2)    # shape (..., 2, 2, basis.npix)
+    """
+
+    def __init__(self, nside, nmax, precision='double'):
+        """
+        Input:
+        nside - HEALPix resolution parameter
+        nmax - maximum degree n of the modes of the beams to be evaluated
+        precision - 'double' (complex128) or 'single' (complex64) evaluation, see DirectionBasis
+        """
+        (za_ring, n_pix, az0, start) = beam_tools.get_healpix_rings(nside)
+        self.nside = int(nside)
+        self.nmax = nmax
+        self.precision = precision
+        self.ring_basis = DirectionBasis([0.], za_ring, nmax, grid=True, precision=precision, phi_fft=False)
+        self.dtype = self.ring_basis.dtype
+        self.npix = int(start[-1] + n_pix[-1])
+        self.shape = (self.npix,)
+
+        self.weights = np.empty(self.npix)
+        self.weights.fill(math.pi / (3.0 * self.nside ** 2))
+        self.weights[start[-1]:] *= 0.5   # the horizon splits its pixels in half
+
+        # rings of the same length are consecutive: each of the polar rings, then the equatorial belt
+        # Sigma[j] = sum_m emn_sum[m] * exp(1j * m * (pi/2 - az0)) * exp(-2j * pi * m * j / n_pix)
+        m = np.arange(-nmax, nmax + 1)
+        self.groups = []
+        for length in np.unique(n_pix):
+            rings = np.nonzero(n_pix == length)[0]
+            phase = np.exp(1.0j * np.outer(math.pi / 2 - az0[rings], m)).astype(self.dtype)
+            self.groups.append((int(length), rings[0], rings[-1] + 1, phase, np.mod(m, length)))
+
+    def get_nbytes(self):
+        """Return the memory used by the basis (bytes)"""
+        return (self.ring_basis.A.nbytes + self.ring_basis.B.nbytes + self.weights.nbytes +
+                sum([phase.nbytes for (length, first, stop, phase, m_index) in self.groups]))
+
+    def _ring_fft(self, emn_sum):
+        """Return the sum over m of emn_sum (..., n_rings, 2*nmax+1) for all the pixels, shape (..., npix)"""
+        Sigma = []
+        for (length, first, stop, phase, m_index) in self.groups:
+            C = np.zeros(emn_sum.shape[:-2] + (stop - first, length), dtype=self.dtype)
+            if length >= len(m_index):
+                C[..., m_index] = emn_sum[..., first:stop, :] * phase
+            else:  # fewer pixels in the ring than m values, the m values alias
+                np.add.at(C, (Ellipsis, m_index), emn_sum[..., first:stop, :] * phase)
+            Sigma.append(np.fft.fft(C, axis=-1).astype(self.dtype, copy=False).reshape(C.shape[:-2] + (-1,)))
+        return np.concatenate(Sigma, axis=-1)
+
+    def get_sigma(self, Q1, Q2):
+        """Return (Sigma_T, Sigma_P), the theta and phi polarised fields for one or more sets of
+        accumulated coefficients Q1, Q2 of shape (..., n_mn), with shape Q1.shape[:-1] + (npix,)"""
+        (emn_T_sum, emn_P_sum) = self.ring_basis.get_emn_sums(Q1, Q2)
+        return (self._ring_fft(emn_T_sum), self._ring_fft(emn_P_sum))
+
+    def get_jones(self, Q1, Q2):
+        """Return the Jones matrices for one or more beams given their accumulated modes
+        Q1, Q2 of shape (..., 2, n_mn), with shape Q1.shape[:-2] + (2, 2, npix) (see DirectionBasis.get_jones)"""
+        (Sigma_T, Sigma_P) = self.get_sigma(Q1, Q2)
+        return sigma_to_jones(Sigma_T, Sigma_P, 1)
+
+    def integrate(self, values):
+        """Return the integral over the sky above the horizon of values of shape (..., npix)"""
+        return np.dot(values, self.weights)
+
+
+def sigma_to_jones(Sigma_T, Sigma_P, n_coord_dims):
+    """Return the Jones matrices of shape (..., 2, 2) + coordinates shape from the theta and phi
+    polarised fields Sigma_T, Sigma_P of shape (..., 2) + coordinates shape, where the 2 is the X and Y pol
+    and n_coord_dims the number of dimensions of the coordinates"""
+    n_lead = Sigma_T.ndim - n_coord_dims - 1   # number of dimensions before the pol axis
+
+    # 2017-05-30 : sign fixed by MS to reflect the fact that phi=90-az (it is not just change of values but
+    # orientation of base vector changes, hence the sign of the Phi component of electric field has to change too
+    Jones = np.stack([Sigma_T, -Sigma_P], axis=n_lead + 1)
+
+    # multiple by XY phase :
+    xy_phase_rad = config.xy_phase_deg * (math.pi / 180.00)
+    xy_phase = math.cos(xy_phase_rad) + 1j * math.sin(xy_phase_rad)
+    if LOGGED_XY_PHASE.get('xy_phase_deg') != config.xy_phase_deg:
+        # only reported when it changes, as this is called for every chunk of points
+        logger.debug('xy_phase = %.6f [rad], xy_phase = %s' % (xy_phase_rad, xy_phase))
+        LOGGED_XY_PHASE['xy_phase_deg'] = config.xy_phase_deg
+    # modify Jones in X polarisation (i.e. first index 0) only:
+    Jones[(slice(None),) * n_lead + (0,)] *= xy_phase
+    return Jones
+
+
+def get_phi_fft_len(phi_1D):
+    """Return the number of steps L around the circle of a uniform phi axis (radians),
+    i.e. 2*pi/step if it is an integer, or None if the axis is not uniform or L is not an integer.
+    The sum over m of a gridded beam is then a discrete Fourier transform of length L along phi."""
+    phi_1D = np.asarray(phi_1D, dtype=np.float64)
+    if len(phi_1D) < 2:
+        return None
+    step = (phi_1D[-1] - phi_1D[0]) / (len(phi_1D) - 1)
+    if step <= 0:
+        return None
+    if np.max(np.abs(phi_1D - (phi_1D[0] + np.arange(len(phi_1D)) * step))) > 1e-9 * max(1., abs(phi_1D).max()):
+        return None
+    fft_len = 2 * math.pi / step
+    if abs(fft_len - round(fft_len)) > 1e-6:
+        return None
+    return int(round(fft_len))
+
+
+def P1sin_norm_array(nmax, theta):
+    r"""Calculate C_MN * P_{n}^{|m|}(cos\theta)/sin(theta) and C_MN * P_{n}^{|m|+1}(cos\theta)
+    for all n=1..nmax, m=-n..n (FEKO order) and all theta in one pass, where
+    C_MN = sqrt(0.5 * (2n+1) * (n-|m|)! / (n+|m|)!) are the pre-multiplying constants in (1) of
+    "Calculating Far-Field Radiation Based on FEKO Spherical Wave Coefficients".
+
+    This is equivalent to C_MN times the output of P1sin_array, but uses the standard
+    recurrences of the normalised associated Legendre functions (including the Condon-Shortley
+    phase, as scipy's lpmv), so that no factorials are needed and it stays accurate for
+    high degrees. For m>=1 the recurrence is done on P/sin(theta) directly, which gives the
+    analytic limits at theta=0 and theta=pi (-/+ C_MN n(n+1)/2 for |m|=1 and 0 for |m|>=2).
+    For m=0, P/sin(theta) is set to 0 at the poles, as in P1sin (it is always multiplied by m).
+
+    Input:
+    nmax - maximum degree n, must be >=1
+    theta - 1-D array of angles (rad)
+
+    Output:
+    P_sin, P1 - arrays of shape (len(theta), nmax^2+2*nmax)
+    """
+    theta = np.array(theta, dtype=np.float64, ndmin=1)
+    u = np.cos(theta)
+    sin_theta = np.sin(theta)
+    poles = (theta == 0) | (theta == math.pi)
+    sin_theta[poles] = 0.0
+    u[theta == 0] = 1.0
+    u[theta == math.pi] = -1.0
+
+    n_theta = len(theta)
+    P_sin = np.empty((n_theta, nmax ** 2 + 2 * nmax))
+    P1 = np.empty((n_theta, nmax ** 2 + 2 * nmax))
+
+    # Normalised functions of the current and previous two degrees, for m=0..n+1
+    # (row m=0 holds P_{n}^{0}, rows m>=1 hold P_{n}^{m}/sin(theta))
+    P_nm1 = np.zeros((nmax + 2, n_theta))
+    P_nm2 = np.zeros((nmax + 2, n_theta))
+    P_nm1[0] = math.sqrt(0.5)  # n=0
+    sectoral = -math.sqrt(0.75) * np.ones(n_theta)  # P_{1}^{1}/sin(theta)
+    sin_nonzero = np.where(poles, 1.0, sin_theta)
+    for n in range(1, nmax + 1):
+        P_n = np.zeros((nmax + 2, n_theta))
+        m = np.arange(0, n)
+        # P_{n}^{m} = a u P_{n-1}^{m} - b P_{n-2}^{m} for m<n (also valid for the divided rows)
+        a = np.sqrt((4.0 * n ** 2 - 1) / (n ** 2 - m ** 2))
+        b = np.sqrt((2.0 * n + 1) * np.maximum((n - 1) ** 2 - m ** 2, 0) / ((2.0 * n - 3) * (n ** 2 - m ** 2)))
+        P_n[0:n] = a[:, None] * u * P_nm1[0:n] - b[:, None] * P_nm2[0:n]
+        # P_{n}^{n}/sin(theta) = -sqrt((2n+1)/(2n)) sin(theta) P_{n-1}^{n-1}/sin(theta)
+        if n > 1:
+            sectoral = -math.sqrt((2.0 * n + 1) / (2.0 * n)) * sin_theta * sectoral
+        P_n[n] = sectoral
+
+        # |m| for m=-n..n and the rows to populate for this n
+        abs_m = np.abs(np.arange(-n, n + 1))
+        ind_start = (n - 1) ** 2 + 2 * (n - 1)  # start index to populate
+        ind_stop = n ** 2 + 2 * n  # stop index to populate
+        P_sin_n = P_n[abs_m]
+        P_sin_n[abs_m == 0] = np.where(poles, 0.0, P_n[0] / sin_nonzero)
+        P_sin[:, ind_start:ind_stop] = P_sin_n.T
+        # C_MN P_{n}^{|m|+1} = sqrt((n-|m|)(n+|m|+1)) times normalised P_{n}^{|m|+1}
+        P1[:, ind_start:ind_stop] = (np.sqrt((n - abs_m) * (n + abs_m + 1.0))[:, None] * sin_theta * P_n[abs_m + 1]).T
+
+        P_nm2 = P_nm1
+        P_nm1 = P_n
+    return (P_sin, P1)
+
+
+# Reference implementations using scipy's lpmv, no longer used by the beam calculation
+# (see P1sin_norm_array), kept to check it against
 
 # Rick 19-12-2016
 # calculate P^|m|_n(cos(theta))/sin(theta) and P^(|m|+1)_n(cos(theta))
@@ -654,7 +1901,7 @@ def P1sin_array(nmax, theta):
     sin_theta = np.sin(theta)
     # Make sure that we don't divide by 0 (sin(0) = sin(pi) = 0 ) proper results
     # are inserted at the end of this function. Set to NaN for now
-    sin_theta[(theta == 0) | (theta == math.pi)] = np.NaN
+    sin_theta[(theta == 0) | (theta == math.pi)] = np.nan
     # create at forehand
     P_sin = np.zeros((nmax ** 2 + 2 * nmax, np.size(theta)))
     P1 = np.zeros((nmax ** 2 + 2 * nmax, np.size(theta)))
@@ -691,7 +1938,7 @@ def P1sin_array(nmax, theta):
 
 
 def P1sin(nmax, theta):
-    """Create the Legendre function flavors for FF expansion using spherical wave
+    r"""Create the Legendre function flavors for FF expansion using spherical wave
        See:
        Calculating Far-Field Radiation Based on FEKO Spherical Wave Coefficients,
        draft 10 June 2015
@@ -705,6 +1952,8 @@ def P1sin(nmax, theta):
        Output:
        1. P_sin: P_{n}^{|m|}(cos\theta)/sin(theta) with FEKO order M,N
        1. P1: P_{n}^{|m|+1}(cos\theta) with FEKO order M,N
+
+       The beam calculation uses P1sin_norm_array, this is kept as a reference.
     """
 
     # initialize for nmax, we have 2(1+...+nmax)+nmax=nmax^2+2*nmax long array
@@ -751,7 +2000,7 @@ def P1sin(nmax, theta):
             # approach 2: based on slope estimate
             # Pn(cos x)/sin x = -dPn(u)/du
             Pu_mdelu = lpmv(orders, n, u - delu)
-            Pm_sin[1, 0] = -(P[0] - Pu_mdelu[0]) / delu  # backward difference
+            Pm_sin[1, 0] = -(P[0, 0] - Pu_mdelu[0, 0]) / delu  # backward difference
 
             # m>=2, value is 0, so initial values are OK
         elif u == -1:
@@ -762,7 +2011,7 @@ def P1sin(nmax, theta):
             # approach 2: based on slope estimate
             # Pn(cos x)/sin x = -dPn(u)/du
             Pu_mdelu = lpmv(orders, n, u - delu)
-            Pm_sin[1, 0] = -(Pu_mdelu[0] - P[0]) / delu  # forward difference
+            Pm_sin[1, 0] = -(Pu_mdelu[0, 0] - P[0, 0]) / delu  # forward difference
         else:
             Pm_sin = P / sin_th
 
@@ -799,6 +2048,226 @@ def get_grid(unit, pixels_per_deg):
     return {'theta': theta, 'phi': phi, 'theta_1D': theta_1D, 'phi_1D': phi_1D}
 
 
+class InterpPlan(object):
+    """Interpolation of complex gridded beams (see Beam.get_gridded_response) onto a set of
+    coordinates.
+
+    The region of the grid needed for the coordinates, the indices of the surrounding grid
+    points and the interpolation weights are calculated once. interpolate() then applies
+    them to any complex array with the grid on the last two axes, e.g. all four Jones
+    terms of both polarisations, for any number of beams or frequencies at once.
+    The same plan can be reused for all the channels of an image cube:
+
+    plan = InterpPlan(az, za, pixels_per_deg=5)
+    for freq in freqs:
+        j = primary_beam.MWA_Tile_full_EE(za, az, freq, delays, jones=True, plan=plan)
+
+    Points outside of the grid (e.g. below the horizon) or with NaN coordinates are
+    interpolated to NaN.
+    """
+
+    def __init__(self, phi_arr, theta_arr, pixels_per_deg=5, method='linear'):
+        """
+        Input:
+        phi_arr - azimuth angles (radians), north through east
+        theta_arr - zenith angles (radians), array of the same shape as phi_arr
+        pixels_per_deg - number of pixels per degree along phi and theta axes of the grid
+        method - 'linear' (bilinear) or 'cubic' (bicubic convolution, Keys 1981)
+        """
+        if method not in ['linear', 'cubic']:
+            e = 'Interpolation method %s not supported' % method
+            logger.error(e)
+            raise ValueError(e)
+        phi_arr = np.array(phi_arr, dtype=np.float64, ndmin=1)
+        theta_arr = np.array(theta_arr, dtype=np.float64, ndmin=1)
+        if phi_arr.shape != theta_arr.shape:
+            e = 'Theta (shape %s) and phi (shape %s) must be the same shape'
+            logger.error(e % (np.shape(theta_arr), np.shape(phi_arr)))
+            raise ValueError(e % (np.shape(theta_arr), np.shape(phi_arr)))
+
+        self.method = method
+        self.pixels_per_deg = pixels_per_deg
+        self.shape = phi_arr.shape
+        # cubic interpolation needs 2 grid points on each side and at least 4 points along each axis
+        mygrid = get_grid_region(phi_arr, theta_arr, pixels_per_deg, pad=1 if method == 'linear' else 3)
+        self.phi_range = mygrid['phi_range']
+        self.theta_range = mygrid['theta_range']
+        self.phi_1D = mygrid['phi_1D']
+        self.theta_1D = mygrid['theta_1D']
+        n_phi = len(self.phi_1D)
+        n_theta = len(self.theta_1D)
+
+        # fractional grid indices
+        step = deg2rad / pixels_per_deg
+        phi_pos = (mygrid['phi'].ravel() - self.phi_1D[0]) / step
+        theta_pos = (theta_arr.ravel() - self.theta_1D[0]) / step
+        tol = 1e-9   # allow for rounding errors of points on the edge of the grid
+        self.valid = (phi_pos >= -tol) & (phi_pos <= n_phi - 1 + tol) & \
+                     (theta_pos >= -tol) & (theta_pos <= n_theta - 1 + tol)
+        (phi_ind, phi_weights) = get_interp_weights(np.where(self.valid, phi_pos, 0), n_phi, method)
+        (theta_ind, theta_weights) = get_interp_weights(np.where(self.valid, theta_pos, 0), n_theta, method)
+
+        # the grid is separable, so only the indices and weights along each axis are kept, shape
+        # (2 or 4, n_points), and those of the 4 or 16 surrounding grid points are formed in interpolate()
+        self.phi_index = np.array(phi_ind, dtype=np.int32)
+        self.theta_index = np.array(theta_ind, dtype=np.int32)
+        self.phi_weight = np.array(phi_weights, dtype=np.float64)
+        self.theta_weight = np.array(theta_weights, dtype=np.float64)
+
+    def interpolate(self, gridded):
+        """Interpolate gridded of shape (..., n_phi, n_theta), on the region of the grid given by
+        phi_range and theta_range (i.e. axes phi_1D, theta_1D), onto the coordinates of the plan.
+        Returns an array of shape gridded.shape[:-2] + shape of the coordinates"""
+        gridded = np.asarray(gridded)
+        if gridded.shape[-2:] != (len(self.phi_1D), len(self.theta_1D)):
+            e = 'Gridded array of shape %s does not match the grid of the interpolation plan %s'
+            logger.error(e % (gridded.shape, (len(self.phi_1D), len(self.theta_1D))))
+            raise ValueError(e % (gridded.shape, (len(self.phi_1D), len(self.theta_1D))))
+        flat = gridded.reshape(gridded.shape[:-2] + (-1,))
+        # single precision grids (see DirectionBasis) give single precision results
+        dtype = np.result_type(gridded.dtype, np.float32)
+        weight_dtype = np.zeros(1, dtype=dtype).real.dtype
+        result = np.zeros(gridded.shape[:-2] + self.valid.shape, dtype=dtype)
+        n_theta = len(self.theta_1D)
+        for (phi_index, phi_weight) in zip(self.phi_index, self.phi_weight):
+            for (theta_index, theta_weight) in zip(self.theta_index, self.theta_weight):
+                # flat index into the (n_phi, n_theta) grid and weight of this surrounding grid point
+                index = phi_index * n_theta + theta_index
+                weight = (phi_weight * theta_weight).astype(weight_dtype, copy=False)
+                result += np.take(flat, index, axis=-1) * weight
+        result[..., ~self.valid] = complex(np.nan, np.nan) if np.iscomplexobj(result) else np.nan
+        return result.reshape(gridded.shape[:-2] + self.shape)
+
+    def get_nbytes(self):
+        """Return the memory (bytes) used by the indices and weights of the plan"""
+        return beam_cache.get_nbytes([self.phi_index, self.theta_index, self.phi_weight, self.theta_weight,
+                                      self.valid])
+
+
+def get_interp_weights(pos, n, method='linear', a=-0.5):
+    """Return the indices and weights of the grid points used to interpolate at fractional
+    grid indices pos (0<=pos<=n-1) along an axis of n grid points.
+
+    method 'linear' uses the 2 surrounding grid points, 'cubic' the 4 surrounding grid points
+    with the cubic convolution kernel of Keys (1981), with parameter a. At the edges of the grid
+    the missing points are extrapolated as in Keys (1981), i.e. f[-1] = 3f[0] - 3f[1] + f[2],
+    so all the points used are within the grid (requires n>=4).
+
+    Output:
+    indices, weights - lists of arrays of the shape of pos, the interpolated value is
+                       sum(weights[i] * f[indices[i]])
+    """
+    pos = np.clip(pos, 0, n - 1)
+    if method == 'linear':
+        i0 = np.clip(np.floor(pos).astype(int), 0, max(n - 2, 0))
+        t = pos - i0
+        return ([i0, np.minimum(i0 + 1, n - 1)], [1 - t, t])
+
+    def near(x):  # |x| <= 1
+        return (a + 2) * x ** 3 - (a + 3) * x ** 2 + 1
+
+    def far(x):  # 1 < |x| < 2
+        return a * x ** 3 - 5 * a * x ** 2 + 8 * a * x - 4 * a
+
+    i0 = np.clip(np.floor(pos).astype(int), 0, n - 2)
+    t = pos - i0
+    w = [far(1 + t), near(t), near(1 - t), far(2 - t)]   # weights of points i0-1 ... i0+2
+    # use the window of 4 grid points start ... start+3 inside the grid
+    start = np.clip(i0 - 1, 0, n - 4)
+    weights = [np.zeros_like(t) for i in range(4)]
+    for k in range(4):
+        rel_ind = i0 - 1 + k - start    # index of point i0-1+k within the window
+        for j in range(4):
+            weights[j] += np.where(rel_ind == j, w[k], 0)
+        # extrapolated points before the start and after the end of the grid
+        weights[0] += np.where(rel_ind == -1, 3 * w[k], 0)
+        weights[1] += np.where(rel_ind == -1, -3 * w[k], 0)
+        weights[2] += np.where(rel_ind == -1, w[k], 0)
+        weights[3] += np.where(rel_ind == 4, 3 * w[k], 0)
+        weights[2] += np.where(rel_ind == 4, -3 * w[k], 0)
+        weights[1] += np.where(rel_ind == 4, w[k], 0)
+    return ([start + j for j in range(4)], weights)
+
+
+def get_grid_region(phi_arr, theta_arr, pixels_per_deg, pad=1, max_fraction=0.5):
+    """Return the region of the phi (Az), theta (ZA) grid of get_grid('rad', pixels_per_deg)
+    needed to interpolate the beam at the given coordinates, i.e. the bounding box of the
+    coordinates, padded by pad grid points and aligned with the full grid.
+
+    Along phi, the smallest arc containing all the azimuths is used, so e.g. a field
+    around north (Az=350-10 deg) gives a region from -10 to 10 deg instead of 0-360 deg.
+    If the region is larger than max_fraction of the full grid, the full grid is returned,
+    as it is then better to calculate (and cache) the full grid.
+
+    Input:
+    phi_arr - azimuth angles (radians), north through east
+    theta_arr - zenith angles (radians)
+    pixels_per_deg - number of pixels per degree along phi and theta axes
+    pad - number of grid points to add on each side of the bounding box
+
+    Output:
+    dictionary with
+    phi_range, theta_range - (start, stop) indices of the grid points along the phi and theta
+                             axes, phi indices may be negative or beyond 360 deg
+    phi_1D, theta_1D - phi and theta axes of the region (radians)
+    phi - phi_arr wrapped into the phi range of the region (radians)
+    """
+    degs_per_pixel = 1. / pixels_per_deg
+    step = degs_per_pixel * deg2rad
+    n_phi = int(360 / degs_per_pixel) + 1
+    n_theta = int(90 / degs_per_pixel) + 1
+    phi_range = (0, n_phi)
+    theta_range = (0, n_theta)
+
+    phi_arr = np.asarray(phi_arr, dtype=np.float64)
+    theta_arr = np.asarray(theta_arr, dtype=np.float64)
+    phi_wrapped = np.mod(phi_arr, 2 * math.pi)
+    valid = np.isfinite(phi_wrapped) & np.isfinite(theta_arr)
+    if valid.any():
+        theta_valid = theta_arr[valid]
+        theta_start = max(int(math.floor(theta_valid.min() / step)) - pad, 0)
+        theta_stop = min(int(math.ceil(theta_valid.max() / step)) + pad + 1, n_theta)
+        if theta_start < theta_stop:
+            theta_range = (theta_start, theta_stop)
+
+        # number of grid cells around the circle, the smallest arc is only found if it is an integer
+        n_cells = int(round(360 / degs_per_pixel))
+        if abs(n_cells - 360 / degs_per_pixel) < 1e-6:
+            # find the largest gap between occupied cells around the circle,
+            # the region is the complement of it
+            occupied = np.zeros(n_cells, dtype=bool)
+            occupied[np.minimum((phi_wrapped[valid] / step).astype(int), n_cells - 1)] = True
+            if not occupied.all():
+                first = np.argmax(occupied)
+                rolled = np.roll(occupied, -first)   # starts with an occupied cell
+                cells = np.flatnonzero(rolled)
+                gaps = np.diff(np.append(cells, n_cells)) - 1   # empty cells after each occupied cell
+                i = np.argmax(gaps)
+                start = (cells[(i + 1) % len(cells)] + first) % n_cells   # first occupied cell after the gap
+                n_occupied = n_cells - gaps[i]
+                phi_range = (int(start) - pad, int(start + n_occupied) + pad + 1)
+        else:
+            phi_start = max(int(math.floor(phi_wrapped[valid].min() / step)) - pad, 0)
+            phi_stop = min(int(math.ceil(phi_wrapped[valid].max() / step)) + pad + 1, n_phi)
+            phi_range = (phi_start, phi_stop)
+
+    if (phi_range[1] - phi_range[0]) * (theta_range[1] - theta_range[0]) > max_fraction * n_phi * n_theta:
+        phi_range = (0, n_phi)
+        theta_range = (0, n_theta)
+
+    phi_1D = np.arange(phi_range[0], phi_range[1]) * step
+    theta_1D = np.arange(theta_range[0], theta_range[1]) * step
+    # wrap the azimuths into [phi_1D[0], phi_1D[0] + 2pi)
+    phi = phi_1D[0] + np.mod(phi_arr - phi_1D[0], 2 * math.pi)
+    if phi_range == (0, n_phi):
+        # keep the original azimuths (e.g. 360 deg) where they are already within the full grid
+        inside = (phi_arr >= 0) & (phi_arr <= phi_1D[-1])
+        phi = np.where(inside, phi_arr, phi)
+
+    return {'phi_range': phi_range, 'theta_range': theta_range,
+            'phi_1D': phi_1D, 'theta_1D': theta_1D, 'phi': phi}
+
+
 if __name__ == "__main__":
 
     logger.setLevel(logging.DEBUG)
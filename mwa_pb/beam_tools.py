@@ -93,6 +93,54 @@ def makeAZZA_dOMEGA(npix=256, projection='SIN'):
     return (az, za, n_total, dOMEGA)
 
 
+def get_healpix_rings(nside):
+    """
+       Return the iso-latitude rings of the pixels of a HEALPix map of resolution nside
+       (RING ordering) above the horizon, where the pole of the map is the zenith,
+       i.e. theta is the ZA and phi is the azimuth (north through east).
+       These are the rings 1..2*nside, the last one being on the horizon.
+       Returns (za, n_pix, az0, start): arrays of the ZA of each ring (radian), its number of pixels,
+       the azimuth of its first pixel (radian) and the index of its first pixel in the map.
+       The pixels of ring i are at azimuths az0[i] + 2*pi*j/n_pix[i] for j=0..n_pix[i]-1.
+    """
+    nside = int(nside)
+    if nside < 1:
+        e = 'Invalid HEALPix nside %s' % nside
+        logger.error(e)
+        raise ValueError(e)
+    ring = np.arange(1, 2 * nside + 1)
+    polar = ring < nside
+    # polar caps
+    z = 1 - ring ** 2 / (3.0 * nside ** 2)
+    n_pix = 4 * ring
+    az0 = math.pi / (4.0 * ring)
+    # equatorial belt, every other ring is shifted by half a pixel
+    z[~polar] = 4 / 3.0 - 2 * ring[~polar] / (3.0 * nside)
+    n_pix[~polar] = 4 * nside
+    az0[~polar] = np.where((ring[~polar] + nside) % 2 == 1, 0, math.pi / (4.0 * nside))
+    start = np.concatenate([[0], np.cumsum(n_pix)[:-1]])
+    return (np.arccos(z), n_pix, az0, start)
+
+
+def makeAZZA_healpix(nside):
+    """
+       Make azimuth and zenith angle arrays for the pixels of a HEALPix map of resolution nside
+       (RING ordering) above the horizon, where the pole of the map is the zenith (see get_healpix_rings).
+       These are the first 2*nside*(3*nside+1) pixels of the map, ending with the ring on the horizon.
+       Returns (az, za, dOMEGA). Angles are in radian, dOMEGA is the solid angle of each pixel (sr),
+       halved on the horizon so that the sum of dOMEGA is 2*pi.
+    """
+    (za_ring, n_pix, az0, start) = get_healpix_rings(nside)
+    ring = np.repeat(np.arange(len(n_pix)), n_pix)
+    j = np.arange(ring.size) - start[ring]
+    az = az0[ring] + 2 * math.pi * j / n_pix[ring]
+    za = za_ring[ring]
+    dOMEGA = np.empty(ring.size)
+    dOMEGA.fill(math.pi / (3.0 * nside ** 2))
+    dOMEGA[start[-1]:] *= 0.5
+    return (az, za, dOMEGA)
+
+
 def makeUnpolInstrumentalResponse(j1, j2):
     # TODO: check this description below. I think Jones dimensions are now swapped
     """
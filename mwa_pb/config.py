@@ -15,6 +15,41 @@ datadir = os.path.join(os.path.dirname(__file__), 'data')
 # 2016 beam model
 h5file = os.path.join(datadir, 'mwa_full_embedded_element_pattern.h5')
 h5fileversion = "UNDEFINED"
+# optional directory with the coefficients of h5file compiled by beam_full_EE.compile_coefficients,
+# used instead of h5file if set (or set with the MWA_PB_COEFFICIENT_STORE environment variable)
+coefficient_store = os.environ.get('MWA_PB_COEFFICIENT_STORE')
+
+# Optional on-disk cache of accumulated full EE beam modes shared between processes.
+# Disabled if None, can also be set with the MWA_PB_CACHE_DIR environment variable.
+BEAM_CACHE_DIR = os.environ.get('MWA_PB_CACHE_DIR')
+# maximum total size of the disk cache in bytes, least recently used entries are removed first
+BEAM_CACHE_MAX_BYTES = 1024 ** 3
+
+# memory budget (bytes) of the cache of gridded beams used by full EE get_interp_response, for all frequencies
+GRIDDED_BEAM_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# maximum number of full EE ApertureArray objects kept by beam_full_EE.get_AA_Cached (one per model frequency)
+# and their total memory (bytes), i.e. their interpolated coefficients (gridded beams are cached separately)
+AA_CACHE_MAX_ENTRIES = 64
+AA_CACHE_MAX_BYTES = 1024 ** 3
+
+# memory budget (bytes) of the cache of full EE coefficients read from the h5 file, for all tabulated frequencies
+COEFFICIENT_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# memory budget (bytes) of the intermediate arrays of the chunked full EE evaluation (Beam.get_FF_chunked)
+FF_CHUNK_MAX_BYTES = 256 * 1024 ** 2
+# number of threads evaluating the chunks in parallel (each uses up to FF_CHUNK_MAX_BYTES)
+FF_N_WORKERS = 1
+
+# maximum number of tabulated frequencies of the 2014 (mwa_tile) dipole lookup table for which the
+# interpolating splines are kept
+DIPOLE_SPLINE_CACHE_MAX_ENTRIES = 8
+# maximum number of frequencies for which the 2014 (mwa_tile) tile model keeps the LU factorisation of the
+# impedance matrix and the zenith normalisation of the array factors
+TILE_SOLVE_CACHE_MAX_ENTRIES = 64
+# memory budget (bytes) of the intermediate arrays of the 2014 (mwa_tile) array factor, which is evaluated
+# in blocks of points of this size
+TILE_AF_CHUNK_MAX_BYTES = 64 * 1024 ** 2
 
 __version__ = "1.2.0"
 
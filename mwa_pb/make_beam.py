@@ -11,6 +11,7 @@ from astropy.coordinates import SkyCoord
 from astropy.io import fits
 import astropy.wcs as pywcs
 
+from . import beam_full_EE
 from . import config
 from . import primary_beam
 
@@ -189,6 +190,10 @@ def make_beam(filename, ext=0, delays=None, jones=False,
 
     tempY = numpy.zeros(f[ext].data.shape)  # copy to prevent rY from overwriting rX in the loop below
     rX, rY, J = None, None, None
+    plan = None
+    if (model == '2016') and interp:
+        # the coordinates are the same for all frequencies, so only work out the interpolation once
+        plan = beam_full_EE.InterpPlan(phi, theta)
     for freqindex in range(len(frequencies)):
         logger.debug(
             'Time (get beam): %s , frequency = %.2f' % (datetime.datetime.now().time(), frequencies[freqindex]))
@@ -218,14 +223,16 @@ def make_beam(filename, ext=0, delays=None, jones=False,
                                                            delays=delays,
                                                            zenithnorm=True,
                                                            power=True,
-                                                           interp=interp)
+                                                           interp=interp,
+                                                           plan=plan)
                 else:
                     J = primary_beam.MWA_Tile_full_EE(theta, phi,
                                                       freq=frequencies[freqindex],
                                                       delays=delays,
                                                       zenithnorm=True,
                                                       jones=True,
-                                                      interp=interp)
+                                                      interp=interp,
+                                                      plan=plan)
             elif model == '2014':
                 if not jones:
                     rX, rY = primary_beam.MWA_Tile_advanced(theta, phi,
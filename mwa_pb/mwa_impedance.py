@@ -139,6 +139,9 @@ class LNAImpedance(object):
                               14.955 - 79.614j, 14.876 - 79.266j, 14.839 - 78.892j, 14.723 - 78.569j,
                               14.683 - 78.282j, 14.643 - 78.058j, 14.614 - 77.894j, 14.594 - 77.713j],
                              dtype=numpy.complex)
+        # shared by all users of the object, so make them read-only
+        self.freq.flags.writeable = False
+        self.Z.flags.writeable = False
 
     def getZ(self, freq):
         """Return the interpolated LNA impedance (Ohms) for the freq (Hz)
@@ -182,6 +185,9 @@ class TileImpedanceMatrix(object):
         #            i = numpy.loadtxt(imagfile)
         #            self.Zmatrix[freqind,...] = r+1j*i
         #            freqind += 1
+        # the tables are shared by all users of the object, so make them read-only
+        self.Zmatrix.flags.writeable = False
+        self.freqs.flags.writeable = False
         logger.debug("Loaded MWA tile impedance matrix with " + str(nfreqs) + " freqs")
         logger.debug("Freqs are: " + str(self.freqs))
 
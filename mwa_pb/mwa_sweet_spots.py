@@ -237,6 +237,16 @@ def get_delays(gridpoint_idx, gridpoint_list=None, raw_delays=False):
         return np.vstack((delays, delays))
 
 
+def get_all_delays(gridpoint_list=None):
+    """Return (gridpoints, delays): the numbers of all the gridpoints and their delays as an array
+    of shape (len(gridpoints), 2, 16), e.g. for beam_full_EE.BeamSet"""
+    if gridpoint_list is None:
+        gridpoint_list = all_grid_points
+    gridpoints = sorted(gridpoint_list.keys())
+    delays = np.array([gridpoint_list[gridpoint][4] for gridpoint in gridpoints], dtype=np.float64)
+    return (gridpoints, np.repeat(delays[:, None, :], 2, axis=1))
+
+
 if __name__ == '__main__':
     az = 0
     if len(sys.argv) > 1:
@@ -4,7 +4,6 @@
 Randall Wayth. March 2014, based on the work of Adrian Sutinjo.
 """
 
-import copy
 import logging
 
 import numpy
@@ -12,7 +11,9 @@ import numpy
 import astropy.io.fits as pyfits
 
 from scipy import interpolate
+from scipy import linalg
 
+import beam_cache
 import config
 import mwa_impedance
 
@@ -66,14 +67,13 @@ class Dipole(object):
             self.gain = numpy.eye(2, dtype=numpy.complex64)
         else:
             self.gain = gain
-        self.interp_freq = 0.0
         self.lookup = None
         self.lookup_za = None
         self.lookup_ph = None
-        self.i00_real, self.i01_real, self.i10_real, self.i11_real = (None, None, None, None)
-        self.i00_imag, self.i01_imag, self.i10_imag, self.i11_imag = (None, None, None, None)
-        self.j00norm, self.j01norm, self.j10norm, self.j11norm = (None, None, None, None)
         self.freqs = numpy.array([])
+        # interpolation functions of the lookup table (see getJonesLookup), the only state which
+        # changes after construction, so that a Dipole can be shared between threads
+        self.spline_cache = beam_cache.LRUCache(max_entries=config.DIPOLE_SPLINE_CACHE_MAX_ENTRIES)
         if atype == 'lookup':
             self.loadLookup(lookup_filename)
 
@@ -110,6 +110,9 @@ class Dipole(object):
             self.lookup[i, :, :, 1, 1] = jyp.reshape((nph, nza)).transpose()
         logger.debug('Loaded dipole Jones matrix lookup model from ' + lookup_filename + ' with ' + str(nfreqs) + ' freqs')
         self.freqs = numpy.array(freqs)
+        # the tables are shared by all users of the Dipole, so make them read-only
+        for table in [self.lookup, self.lookup_za, self.lookup_ph, self.freqs]:
+            table.flags.writeable = False
         logger.debug('Supported frequencies (MHz): ' + str(self.freqs / 1e6))
         logger.debug("There are " + str(nza) + " tabulated zenith angles: " + str(self.lookup_za))
         logger.debug("There are " + str(nph) + " tabulated phi angles: " + str(self.lookup_ph))
@@ -133,7 +136,7 @@ class Dipole(object):
     def getJonesLookup(self, az, za, freq):
         """Return the Jones matrix for arrays of az/za for a given freq (Hz)
         this method interpolates from the tablulated numerical results loaded
-        by the constructor"""
+        by the constructor. The interpolation functions are kept in spline_cache."""
         # need to interpolate each of the 4 Jones elements separately and each
         # the real and imag separately (since interpolate.RectBivariateSpline)
         # apparently doesn't handle complex
@@ -144,64 +147,64 @@ class Dipole(object):
             logger.warning("Nearest tabulated impedance matrix freq is more than 2 MHz away from desired freq.")
         logger.info("Selecting matrix for nearest freq " + str(self.freqs[pos]))
 
-        # cache the interpolation functions
-        if self.interp_freq != freq:
-            self.interp_freq = freq
-            logger.debug("Setting new cache lookup freq to " + str(self.freqs[pos]))
-            self.i00_real = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 0, 0].real)
-            self.i00_imag = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 0, 0].imag)
-            self.i01_real = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 0, 1].real)
-            self.i01_imag = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 0, 1].imag)
-            self.i10_real = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 1, 0].real)
-            self.i10_imag = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 1, 0].imag)
-            self.i11_real = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 1, 1].real)
-            self.i11_imag = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph,
-                                                            self.lookup[pos, :, :, 1, 1].imag)
-            # determine normalisation factors. The simulations include all ph angles at za=0.
-            # these are not redundant, and the ph value determines the unit vector directions of
-            # both axes. We should normalise by where the result will be maximal.
-            # For the E-W dipoles, the projection of the ZA unit vec will be max when
-            # pointing east, i.e. when ph=0. For the PH unit vec, this will be when ph=-90 or 90
-            # For the N-S dipoles, projection of ZA onto N-S is max az ph=90 and
-            # proj of ph onto N-S is max when ph=0
-
-            # determine the indices of 0 and 90 degrees of phi in the tabulated values
-            ph0 = numpy.where(self.lookup_ph == 0.0)
-            ph90 = numpy.where(self.lookup_ph == 90.0)
-            th0 = numpy.where(self.lookup_za == 0.0)
-
-            self.j00norm = self.lookup[pos, th0, ph0, 0, 0]
-            self.j01norm = -self.lookup[pos, th0, ph90, 0, 1]  # use -90, not 90.
-            self.j10norm = self.lookup[pos, th0, ph90, 1, 0]
-            self.j11norm = self.lookup[pos, th0, ph0, 1, 1]
+        # cache the interpolation functions, for each tabulated frequency
+        (tx, ty, coeffs, norm) = self.spline_cache.get_or_create(pos, lambda: self.makeSplines(pos))
 
         ph_deg = 90.0 - az * 180.0 / numpy.pi  # ph in degrees
         za_deg = za * 180.0 / numpy.pi
         p = ph_deg < 0
         ph_deg[p] += 360.0
-        j00 = self.i00_real.ev(za_deg.flatten(), ph_deg.flatten()) + 1.0j * self.i00_imag.ev(za_deg.flatten(),
-                                                                                             ph_deg.flatten())
-        j01 = self.i01_real.ev(za_deg.flatten(), ph_deg.flatten()) + 1.0j * self.i01_imag.ev(za_deg.flatten(),
-                                                                                             ph_deg.flatten())
-        j10 = self.i10_real.ev(za_deg.flatten(), ph_deg.flatten()) + 1.0j * self.i10_imag.ev(za_deg.flatten(),
-                                                                                             ph_deg.flatten())
-        j11 = self.i11_real.ev(za_deg.flatten(), ph_deg.flatten()) + 1.0j * self.i11_imag.ev(za_deg.flatten(),
-                                                                                             ph_deg.flatten())
+
+        # the splines of all the Jones elements have the same knots, so the B-spline basis functions
+        # of each point are only calculated once and then applied to the complex coefficients
+        # of the 4 elements (same as RectBivariateSpline.ev of the real and imaginary parts)
+        (ix, bx) = bspline_basis(za_deg.flatten(), tx)
+        (iy, by) = bspline_basis(ph_deg.flatten(), ty)
+        j = numpy.zeros((len(ix), 4), dtype=numpy.complex128)
+        for a in range(bx.shape[1]):
+            for b in range(by.shape[1]):
+                j += (bx[:, a] * by[:, b])[:, None] * coeffs[ix + a, iy + b]
 
         result = numpy.empty((za.shape + (2, 2)), dtype=numpy.complex64)
-        result[..., 0, 0] = j00.reshape(za.shape) / self.j00norm
-        result[..., 0, 1] = -j01.reshape(za.shape) / self.j01norm  # sign flip between az and phi
-        result[..., 1, 0] = j10.reshape(za.shape) / self.j10norm
-        result[..., 1, 1] = -j11.reshape(za.shape) / self.j11norm  # sign flip between az and phi
+        result[...] = (j / norm).reshape(za.shape + (2, 2))
         return result
 
+    def makeSplines(self, pos):
+        """Return (tx, ty, coeffs, norm) the interpolation functions of the 4 Jones elements of the lookup table
+        of tabulated frequency index pos: the knots along za and ph, the complex B-spline coefficients
+        of shape (len(tx) - 4, len(ty) - 4, 4) of the elements in the order 00, 01, 10, 11,
+        and their normalisation factors (including the sign flip between az and phi)"""
+        logger.debug("Setting new cache lookup freq to " + str(self.freqs[pos]))
+        coeffs = []
+        for (i, ii) in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            # RectBivariateSpline doesn't handle complex, so fit the real and imag separately
+            re = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph, self.lookup[pos, :, :, i, ii].real)
+            im = interpolate.RectBivariateSpline(self.lookup_za, self.lookup_ph, self.lookup[pos, :, :, i, ii].imag)
+            (tx, ty) = re.get_knots()
+            coeffs.append(re.get_coeffs() + 1.0j * im.get_coeffs())
+        coeffs = numpy.stack(coeffs, axis=-1).reshape((len(tx) - 4, len(ty) - 4, 4))
+
+        # determine normalisation factors. The simulations include all ph angles at za=0.
+        # these are not redundant, and the ph value determines the unit vector directions of
+        # both axes. We should normalise by where the result will be maximal.
+        # For the E-W dipoles, the projection of the ZA unit vec will be max when
+        # pointing east, i.e. when ph=0. For the PH unit vec, this will be when ph=-90 or 90
+        # For the N-S dipoles, projection of ZA onto N-S is max az ph=90 and
+        # proj of ph onto N-S is max when ph=0
+
+        # determine the indices of 0 and 90 degrees of phi in the tabulated values
+        ph0 = numpy.where(self.lookup_ph == 0.0)[0][0]
+        ph90 = numpy.where(self.lookup_ph == 90.0)[0][0]
+        th0 = numpy.where(self.lookup_za == 0.0)[0][0]
+
+        j00norm = self.lookup[pos, th0, ph0, 0, 0]
+        j01norm = -self.lookup[pos, th0, ph90, 0, 1]  # use -90, not 90.
+        j10norm = self.lookup[pos, th0, ph90, 1, 0]
+        j11norm = self.lookup[pos, th0, ph0, 1, 1]
+        # sign flip between az and phi for the 01 and 11 elements
+        norm = numpy.array([j00norm, -j01norm, j10norm, -j11norm], dtype=numpy.complex128)
+        return (tx, ty, coeffs, norm)
+
     def getJonesShortDipole(self, az, za, freq, zenith_norm=True):
         """Calculate the Jones matrix for a short dipole.
         This is defined by purely geometric projection of unit vectors
@@ -243,7 +246,32 @@ class Dipole(object):
         return "Dipole. Type: " + self.atype + ". height: " + str(self.height) + "m. Gain: " + str(self.gain)
 
 
-DIPOLE_DEFAULT = Dipole('lookup')      # A default Dipole('lookup') object. FOr thread safety, copy.deepcopy this global object
+def bspline_basis(x, t, k=3):
+    """Return (index, basis) for the B-splines of degree k with knots t at points x: basis has shape (len(x), k+1)
+    and holds the values of the basis functions index-k..index (index of the first, of shape len(x)), which are
+    the only non-zero ones at each point. Points outside the knots are moved to the end knots,
+    as in the evaluation of the scipy (FITPACK) splines."""
+    x = numpy.clip(x, t[k], t[len(t) - k - 1])
+    # span of each point, t[span] <= x < t[span+1], the last one includes the end knot
+    span = numpy.clip(numpy.searchsorted(t, x, side='right') - 1, k, len(t) - k - 2)
+    # Cox-de Boor recursion
+    basis = numpy.zeros((len(x), k + 1))
+    basis[:, 0] = 1.0
+    left = numpy.empty((len(x), k + 1))
+    right = numpy.empty((len(x), k + 1))
+    for j in range(1, k + 1):
+        left[:, j] = x - t[span + 1 - j]
+        right[:, j] = t[span + j] - x
+        saved = numpy.zeros(len(x))
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r + 1] + left[:, j - r])
+            basis[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        basis[:, j] = saved
+    return (span - k, basis)
+
+
+DIPOLE_DEFAULT = Dipole('lookup')      # A default Dipole('lookup') object, which can be shared between threads
 
 
 class ApertureArray(object):
@@ -268,22 +296,58 @@ class ApertureArray(object):
         self.ypos = ypos
         self.im = mwa_impedance.TileImpedanceMatrix()
         self.lna_z = mwa_impedance.LNAImpedance()
+        # LU factorisations of the impedance matrices and zenith normalisations of the array factors,
+        # per frequency (see getImpedanceLU and getZenithNorm)
+        self.solve_cache = beam_cache.LRUCache(max_entries=config.TILE_SOLVE_CACHE_MAX_ENTRIES)
+
+    def getImpedanceLU(self, freq):
+        """
+        Return the LU factorisation (see scipy.linalg.lu_factor) of the total impedance matrix of
+        the tile (the tabulated impedance matrix nearest to freq (Hz) and the LNA impedance at freq).
+        It is cached, keyed by the index of the tabulated matrix and the LNA impedance.
+        """
+        pos = numpy.argmin(numpy.abs(self.im.freqs - freq))
+        lna_z = self.lna_z.getZ(freq)
+
+        def factorise():
+            # this code ignores any dipole gain (and crosstalk) terms.
+            # should FIXME it.
+            z_total = self.im.getImpedanceMatrix(freq) + numpy.eye(32) * lna_z
+            return linalg.lu_factor(z_total)
+
+        return self.solve_cache.get_or_create(('lu', pos, complex(lna_z)), factorise)
 
     def getPortCurrents(self, freq, delays=None):
         """
         Return the port currents on a tile given the freq (Hz) and delays (integer)
+        delays can be an array of shape (2, 16) or many sets of delays of shape (N, 2, 16),
+        in which case the result has shape (N, 2, 16) and the port currents of all of them
+        are solved at once
         """
         if delays is None:
             delays = numpy.zeros((2, 16), dtype=numpy.float32)
+        delays = numpy.asarray(delays)
         lam = vel_light / freq
         phases = -2.0 * numpy.pi * delays * (DQ / lam)
         ph_rot = numpy.cos(phases) + 1.0j * numpy.sin(phases)
-        # this code ignores any dipole gain (and crosstalk) terms.
-        # should FIXME it.
-        z_total = self.im.getImpedanceMatrix(freq) + numpy.eye(32) * self.lna_z.getZ(freq)
-        inv_z = numpy.linalg.inv(z_total)
-        port_current = numpy.dot(inv_z, ph_rot.reshape(32)).reshape(2, 16)
-        return port_current
+        # one right-hand side (column) of 32 port voltages per set of delays
+        rhs = ph_rot.reshape((-1, 32)).T
+        port_current = linalg.lu_solve(self.getImpedanceLU(freq), rhs)
+        return port_current.T.reshape(delays.shape)
+
+    def getZenithNorm(self, freq):
+        """
+        Return the absolute values of the X and Y array factors at the zenith of the zenith pointed
+        tile at freq (Hz), which normalise the array factors in getResponse. They are cached per frequency.
+        """
+        def calc():
+            (zax, zay) = self.getArrayFactor(numpy.array([0.0]), numpy.array([0.0]), freq)  # no delays == zenith
+            norm = (numpy.abs(zax), numpy.abs(zay))
+            for a in norm:
+                a.flags.writeable = False   # shared by all callers
+            return norm
+
+        return self.solve_cache.get_or_create(('zenith', freq), calc)
 
     def getArrayFactor(self, az, za, freq=155e6, delays=None):
         """
@@ -297,8 +361,6 @@ class ApertureArray(object):
         """
         if delays is None:
             delays = numpy.zeros((2, 16), dtype=numpy.float32)
-        lam = vel_light / freq
-        port_current = self.getPortCurrents(freq, delays)
 
         # check for input scalars vs arrays. If the input is scalar, then
         # convert it so that numpy array-based operations are possible
@@ -310,21 +372,57 @@ class ApertureArray(object):
             za = numpy.matrix(za, dtype=numpy.float32)
         assert az.shape == za.shape, "Input az and za arrays must have same dimenions"
 
-        # now calculate the array factor using these port currents
-        sz = numpy.sin(za)
-        kx = (2.0 * numpy.pi / lam) * numpy.sin(az) * sz
-        ky = (2.0 * numpy.pi / lam) * numpy.cos(az) * sz
-        ax = numpy.zeros_like(az, dtype=numpy.complex64)
-        ay = numpy.zeros_like(az, dtype=numpy.complex64)
-        for i in range(len(self.xpos)):
-            ph = kx * self.xpos[i] + ky * self.ypos[i]
-            ax += port_current[1, i] * (numpy.cos(ph) + 1.0j * numpy.sin(ph))  # X dipoles
-            ay += port_current[0, i] * (numpy.cos(ph) + 1.0j * numpy.sin(ph))  # Y dipoles
+        (ax, ay) = self.getArrayFactors(az, za, [freq], numpy.asarray(delays)[None])
+        return (ax[0, 0], ay[0, 0])
+
+    def getArrayFactors(self, az, za, freqs, delays=None):
+        """
+        Get the scalar array factors of the array for many frequencies (Hz) and sets of delays at once.
+        az and za (radian) are numpy arrays of equal shape defining a set
+        of points to calculate the response for.
+        delays is an array of integer delay steps of shape (nbeam, 2, 16), for the Y and X pol
+        respectively (or (2, 16) for nbeam=1).
+        Result (ax, ay) are arrays of shape (nbeam, nfreq) + az.shape
+
+        The phases of the dipoles are one (npoints x 16) matrix per frequency, shared by all the
+        delay sets, and the array factors are its products with the port currents of all of them.
+        The points are evaluated in blocks, so that these matrices use at most config.TILE_AF_CHUNK_MAX_BYTES.
+        """
+        if delays is None:
+            delays = numpy.zeros((2, 16), dtype=numpy.float32)
+        delays = numpy.asarray(delays).reshape((-1, 2, 16))
+        freqs = numpy.array(freqs, dtype=numpy.float64, ndmin=1)
+        az = numpy.asarray(az)
+        za = numpy.asarray(za)
+        assert az.shape == za.shape, "Input az and za arrays must have same dimenions"
+        shape = az.shape
+
+        az = az.ravel()
+        za = za.ravel()
+        port_currents = [self.getPortCurrents(freq, delays) for freq in freqs]    # each of shape (nbeam, 2, 16)
+
+        # per point: three float64 (the path and its phase) and two complex128 (the steering vector)
+        # temporaries per dipole, and the complex128 products for all the delay sets
+        bytes_per_point = len(self.xpos) * (3 * 8 + 2 * 16) + 2 * len(delays) * 16
+        block = max(1, int(config.TILE_AF_CHUNK_MAX_BYTES // bytes_per_point))
+
+        ax = numpy.empty((len(delays), len(freqs), az.size), dtype=numpy.complex64)
+        ay = numpy.empty((len(delays), len(freqs), az.size), dtype=numpy.complex64)
+        for start in range(0, az.size, block):
+            s = slice(start, start + block)
+            # distance along the direction of each point of each dipole, shape (npoints in block, 16)
+            sz = numpy.sin(za[s])
+            path = numpy.outer(numpy.sin(az[s]) * sz, self.xpos) + numpy.outer(numpy.cos(az[s]) * sz, self.ypos)
+            for (i, freq) in enumerate(freqs):
+                lam = vel_light / freq
+                steering = numpy.exp(1.0j * ((2.0 * numpy.pi / lam) * path))
+                ax[:, i, s] = numpy.dot(port_currents[i][:, 1], steering.T)  # X dipoles
+                ay[:, i, s] = numpy.dot(port_currents[i][:, 0], steering.T)  # Y dipoles
         # set the points below the horizon to zero
         p = za >= numpy.pi / 2.0
-        ax[p] = 0.0
-        ay[p] = 0.0
-        return (ax, ay)
+        ax[..., p] = 0.0
+        ay[..., p] = 0.0
+        return (ax.reshape(ax.shape[:2] + shape), ay.reshape(ay.shape[:2] + shape))
 
     def getResponse(self, az, za, freq=155e6, delays=None):
         """
@@ -339,17 +437,32 @@ class ApertureArray(object):
         assert delays is None or numpy.size(delays) == 32, "Expecting 32 delays, got %r" % str(numpy.size(delays))
         if delays is None:
             delays = numpy.zeros((2, 16), dtype=numpy.float32)
-        (ax, ay) = self.getArrayFactor(az, za, freq, delays)
-        # get the zenith response to normalise to:
-        (zax, zay) = self.getArrayFactor(numpy.array([0.0]), numpy.array([0.0]), freq)  # no delays == zenith
-        ax /= numpy.abs(zax)
-        ay /= numpy.abs(zay)
+        return self.getResponses(az, za, [freq], numpy.asarray(delays).reshape((1, 2, 16)))[0, 0]
+
+    def getResponses(self, az, za, freqs, delays=None):
+        """
+        Get the full Jones matrix response of the tile (see getResponse) for many frequencies (Hz)
+        and sets of delays at once. delays is an array of shape (nbeam, 2, 16) (or (2, 16) for nbeam=1).
+        Result is an array of shape (nbeam, nfreq) + az.shape + (2, 2).
+        The dipole response and the phases of the dipoles are only calculated once per frequency.
+        """
+        if delays is None:
+            delays = numpy.zeros((2, 16), dtype=numpy.float32)
+        delays = numpy.asarray(delays).reshape((-1, 2, 16))
+        freqs = numpy.array(freqs, dtype=numpy.float64, ndmin=1)
+        (ax, ay) = self.getArrayFactors(az, za, freqs, delays)
         d = self.dipoles[0]  # for now, assume all dipoles identical FIXME
-        j = d.getJones(az, za, freq)
-        j[..., 0, 0] *= ax
-        j[..., 0, 1] *= ax
-        j[..., 1, 0] *= ay
-        j[..., 1, 1] *= ay
+        j = None
+        for (i, freq) in enumerate(freqs):
+            # get the zenith response to normalise to:
+            (zax, zay) = self.getZenithNorm(freq)
+            ax[:, i] /= zax
+            ay[:, i] /= zay
+            jd = d.getJones(az, za, freq)
+            if j is None:
+                j = numpy.empty((len(delays), len(freqs)) + jd.shape, dtype=jd.dtype)
+            j[:, i, ..., 0, :] = jd[..., 0, :] * ax[:, i, ..., None]
+            j[:, i, ..., 1, :] = jd[..., 1, :] * ay[:, i, ..., None]
         return j
 
 
@@ -357,7 +470,10 @@ APERTURE_ARRAY_DEFAULT = ApertureArray(dipoles=[DIPOLE_DEFAULT] * 16)
 
 
 def get_AA_Cached():
-    return copy.deepcopy(APERTURE_ARRAY_DEFAULT)
+    """Return the default ApertureArray object. It is shared by all callers (and threads):
+    its tabulated data are read-only and its only changing state is the thread-safe
+    spline_cache of its dipoles, so it must not be modified."""
+    return APERTURE_ARRAY_DEFAULT
 
 
 def convertJonesAzEl2HaDec(az, za, lat):
@@ -45,7 +45,11 @@ def MWA_Tile_full_EE(za, az, freq,
                      power=True,
                      jones=False,
                      interp=True,
-                     pixels_per_deg=5):
+                     pixels_per_deg=5,
+                     plan=None,
+                     freq_interp='nearest',
+                     precision='double',
+                     mode_rel_tol=None):
     """
     Use the new MWA tile model from beam_full_EE.py that includes mutual coupling
     and the simulated dipole response. Returns the XX and YY response to an
@@ -55,6 +59,15 @@ def MWA_Tile_full_EE(za, az, freq,
     In this case, the power flag will be ignored.
     If interp=False, the pixels_per_deg will be ignored
 
+    plan - optional beam_full_EE.InterpPlan for az, za (used if interp=True), e.g. created once and
+           reused for all the frequency channels of a cube, in which case pixels_per_deg is ignored
+    freq_interp - 'nearest' to use the nearest frequency in the h5 file, or 'linear' to interpolate the
+                  model coefficients between the two tabulated frequencies either side of freq
+    precision - 'double' (complex128) or 'single' (complex64) evaluation of the model, single precision
+                halves the memory of large beams (see beam_full_EE.DirectionBasis for its accuracy)
+    mode_rel_tol - if given, drop the high degree modes of the beam carrying no more than this fraction
+                   of its power before evaluating it (see beam_full_EE.Beam.truncate_modes)
+
     delays should be a numpy array of size (2,16), although a (16,) list or a (16,) array will also be accepted
 
     az - azimuth angles (radians), north through east.
@@ -86,17 +99,23 @@ def MWA_Tile_full_EE(za, az, freq,
         logger.error('ERROR - az/za data types must be the same, and either floats or 1 or 2 dimensional arrays')
         return None
 
-    tile = beam_full_EE.get_AA_Cached(target_freq_Hz=freq)
+    tile = beam_full_EE.get_AA_Cached(target_freq_Hz=freq, freq_interp=freq_interp)
     mybeam = beam_full_EE.Beam(tile, delays, amps=numpy.ones([2, 16]))  # calling with amplitudes=1 every time - otherwise they get overwritten !!!
+    if mode_rel_tol is not None:
+        mybeam.truncate_modes(mode_rel_tol)
     if interp:
-        j = mybeam.get_interp_response(az, za, pixels_per_deg)
+        if plan is not None:
+            if numpy.prod(plan.shape) != za.size:
+                logger.error('ERROR - interpolation plan for shape %s does not match az/za of shape %s' % (plan.shape, za.shape))
+                return None
+            j = mybeam.get_interp_response(az, za, plan=plan, precision=precision).reshape((2, 2) + za.shape)
+        else:
+            j = mybeam.get_interp_response(az, za, pixels_per_deg, precision=precision)
     else:
-        j = mybeam.get_response(az, za)
+        j = mybeam.get_response(az, za, precision=precision)
     if zenithnorm:
         j = tile.apply_zenith_norm_Jones(j)  # Normalise
 
-    # TO DO: do frequency interpolation here (with 2nd adjacent beam)
-
     # Use swapaxis to place jones matrices in last 2 dimensions
     # insead of first 2 dims.
     if len(j.shape) == 4:
@@ -129,6 +148,92 @@ def MWA_Tile_full_EE(za, az, freq,
         return xx, yy
 
 
+def MWA_Tile_full_EE_multifreq(za, az, freqs,
+                               delays=None,
+                               zenithnorm=True,
+                               power=True,
+                               jones=False,
+                               interp=True,
+                               pixels_per_deg=5,
+                               plan=None,
+                               freq_interp='nearest',
+                               precision='double',
+                               mode_rel_tol=None):
+    """
+    As MWA_Tile_full_EE, but for an array of frequencies at once, e.g. all the channels of a cube.
+
+    The work that does not depend on frequency is only done once: the Legendre and phi terms of
+    the model are calculated for the coordinates (or, if interp=True, the region of the grid
+    covering them) up to the largest degree of all the frequencies, and the interpolation weights
+    are only worked out once. Channels that map to the same tabulated frequency of the h5 file
+    (with freq_interp='nearest') share one beam.
+
+    za - zenith angles (radians), float or array of any shape
+    az - azimuth angles (radians), north through east, same shape as za
+    freqs - array of frequencies (Hz)
+    plan - optional beam_full_EE.InterpPlan for az, za (used if interp=True)
+    The other arguments are as for MWA_Tile_full_EE.
+
+    Returns the Jones matrices of shape (len(freqs),) + za.shape + (2, 2) if jones=True,
+    otherwise the XX and YY responses, each of shape (len(freqs),) + za.shape
+    """
+    za = numpy.asarray(za, dtype=numpy.float64)
+    az = numpy.asarray(az, dtype=numpy.float64)
+    if za.shape != az.shape:
+        logger.error('ERROR - az (shape %s) and za (shape %s) must be the same shape' % (az.shape, za.shape))
+        return None
+    freqs = numpy.array(freqs, dtype=numpy.float64, ndmin=1)
+    if delays is None:
+        delays = numpy.zeros([2, 16])
+
+    # one beam for each distinct model frequency
+    beams = []
+    beam_index = numpy.zeros(len(freqs), dtype=int)
+    model_freqs = {}
+    for i, freq in enumerate(freqs):
+        model_freq = beam_full_EE.select_freqs(beam_full_EE.get_tabulated_freqs(), freq, freq_interp)[0]
+        if model_freq not in model_freqs:
+            tile = beam_full_EE.get_AA_Cached(target_freq_Hz=model_freq, freq_interp=freq_interp)
+            model_freqs[model_freq] = len(beams)
+            beams.append(beam_full_EE.Beam(tile, numpy.copy(delays), amps=numpy.ones([2, 16])))
+            if mode_rel_tol is not None:
+                beams[-1].truncate_modes(mode_rel_tol)
+        beam_index[i] = model_freqs[model_freq]
+    logger.debug('%d frequencies use %d distinct beams' % (len(freqs), len(beams)))
+
+    nmax = max([beam.get_nmax() for beam in beams])
+    if interp:
+        if plan is None:
+            plan = beam_full_EE.InterpPlan(az, za, pixels_per_deg)
+        elif numpy.prod(plan.shape) != za.size:
+            logger.error('ERROR - interpolation plan for shape %s does not match az/za of shape %s' % (plan.shape, za.shape))
+            return None
+        basis = beam_full_EE.DirectionBasis(plan.phi_1D, plan.theta_1D, nmax, grid=True, precision=precision)
+        # one beam at a time, so that only one gridded beam is held in memory
+        j = numpy.empty((len(beams), 2, 2) + plan.shape, dtype=basis.dtype)
+        for i, beam in enumerate(beams):
+            j[i] = plan.interpolate(basis.get_jones(*beam.get_modes()))
+    else:
+        basis = beam_full_EE.DirectionBasis(az, za, nmax, grid=False, precision=precision)
+        j = basis.get_beams_jones(beams)
+    j = j.reshape((len(beams), 2, 2) + za.shape)
+
+    if zenithnorm:
+        for i, beam in enumerate(beams):
+            j[i] = beam.AA.apply_zenith_norm_Jones(j[i])  # Normalise
+
+    # place the frequency axis first and the jones matrices in the last 2 dimensions
+    j = numpy.moveaxis(j[beam_index], [1, 2], [-2, -1])
+    if jones:
+        return j
+
+    xx = numpy.abs(j[..., 0, 0]) ** 2 + numpy.abs(j[..., 0, 1]) ** 2
+    yy = numpy.abs(j[..., 1, 0]) ** 2 + numpy.abs(j[..., 1, 1]) ** 2
+    if not power:
+        xx, yy = (numpy.sqrt(xx), numpy.sqrt(yy))
+    return xx, yy
+
+
 #########
 #########
 def MWA_Tile_advanced(za, az, freq=100.0e6, delays=None, zenithnorm=None, power=True, jones=False):
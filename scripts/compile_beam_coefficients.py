@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""Compile the coefficients of the 2016 (full EE) beam model h5 file into a memory mapped store.
+    e.g.
+    python compile_beam_coefficients.py -o /data/mwa_fee_store
+
+    The store can then be used instead of the h5 file by setting the environment variable
+    MWA_PB_COEFFICIENT_STORE=/data/mwa_fee_store (or config.coefficient_store)
+"""
+
+import logging
+from optparse import OptionParser
+
+from mwa_pb import config
+from mwa_pb import beam_full_EE
+
+# configure the logging
+logging.basicConfig(format='# %(levelname)s:%(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def parse_options():
+    usage = "Usage: %prog [options]\n"
+    usage += '\tCompile the full EE beam model h5 file into a memory mapped coefficient store\n'
+    parser = OptionParser(usage=usage, version=1.00)
+    parser.add_option('-i', '--h5file',
+                      dest="h5file",
+                      default=config.h5file,
+                      help="Beam model h5 file [default %default]",
+                      metavar="FILE")
+    parser.add_option('-o', '--outdir',
+                      dest="outdir",
+                      default=None,
+                      help="Output directory of the coefficient store (required)",
+                      metavar="DIR")
+    (options, args) = parser.parse_args()
+
+    if options.outdir is None:
+        parser.error('Output directory (-o) is required')
+
+    return (options, args)
+
+
+if __name__ == "__main__":
+    (options, args) = parse_options()
+    beam_full_EE.compile_coefficients(options.h5file, options.outdir)
+    logger.info('Coefficients of %s compiled into %s, use it with MWA_PB_COEFFICIENT_STORE=%s' %
+                (options.h5file, options.outdir, options.outdir))
@@ -0,0 +1,69 @@
+"""Shared fixtures of the tests: the mwa_pb modules import each other as top-level modules
+(e.g. import config), so the package directory is put on the path, and the full EE tests use
+a small synthetic h5 file of spherical wave coefficients instead of the real model."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mwa_pb'))
+
+# tabulated frequencies (Hz) and maximum degree of the synthetic full EE model
+H5_FREQS = [140000000, 150000000, 160000000, 170000000]
+H5_NMAX = 8
+
+
+def write_full_EE_h5(path, freqs=H5_FREQS, nmax=H5_NMAX, n_ant=16, seed=1):
+    """Write an h5 file in the format of the full EE model, with random coefficients that decay
+    with the degree n. The antennas and frequencies have different numbers of modes, as in the real file."""
+    h5py = pytest.importorskip('h5py')
+    rng = np.random.RandomState(seed)
+    modes = []
+    for n in range(1, nmax + 1):
+        for s in (1, 2):
+            for m in range(-n, n + 1):
+                modes.append((s, m, n))
+    with h5py.File(path, 'w') as f:
+        f['modes'] = np.array(modes, dtype=np.float64).T
+        for (i_freq, freq) in enumerate(freqs):
+            for pol in 'XY':
+                for ant in range(1, n_ant + 1):
+                    n_ant_max = nmax - (ant % 3) - (i_freq % 2)
+                    n_modes = 2 * (n_ant_max ** 2 + 2 * n_ant_max)
+                    n = np.array([mode[2] for mode in modes[:n_modes]])
+                    amp = rng.uniform(0, 0.5, n_modes) * np.exp(-n / 2.5)
+                    phase = rng.uniform(-180, 180, n_modes)
+                    f['%s%d_%d' % (pol, ant, freq)] = np.vstack([amp, phase])
+
+
+@pytest.fixture(scope='session')
+def h5file(tmp_path_factory):
+    """Path of the synthetic full EE h5 file"""
+    path = str(tmp_path_factory.mktemp('full_EE') / 'full_EE_test.h5')
+    write_full_EE_h5(path)
+    return path
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(5)
+
+
+@pytest.fixture
+def delays(rng):
+    return rng.randint(0, 10, (2, 16)).astype(np.float64)
+
+
+@pytest.fixture
+def amps():
+    amps = np.ones((2, 16))
+    amps[0, 3] = 0.5
+    return amps
+
+
+@pytest.fixture
+def sky_points(rng):
+    """Random (az, za) above the horizon (radians)"""
+    return (rng.uniform(0, 2 * np.pi, 400), rng.uniform(0, np.pi / 2, 400))
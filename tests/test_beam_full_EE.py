@@ -0,0 +1,234 @@
+"""Tests of the full EE beam model (beam_full_EE) on a synthetic h5 file (see conftest.py)"""
+
+import math
+
+import numpy as np
+import pytest
+
+import beam_full_EE
+
+
+def rel_error(a, b):
+    """Maximum absolute difference relative to the maximum of |b|"""
+    return np.nanmax(np.abs(a - b)) / np.nanmax(np.abs(b))
+
+
+def test_normalised_recurrence_matches_lpmv():
+    """P1sin_norm_array equals C_MN times the lpmv based P1sin_array, including at the zenith"""
+    nmax = 20
+    theta = np.concatenate([[0.0], np.linspace(0.01, math.pi - 0.01, 50)])
+    (P_sin_ref, P1_ref) = beam_full_EE.P1sin_array(nmax, theta.copy())
+    (P_sin, P1) = beam_full_EE.P1sin_norm_array(nmax, theta)
+
+    (M, N) = beam_full_EE.get_mode_vectors(nmax)
+    C_MN = np.array([math.sqrt(0.5 * (2 * n + 1) * math.factorial(int(n - abs(m))) / math.factorial(int(n + abs(m))))
+                     for (m, n) in zip(M, N)])
+    assert rel_error(P_sin, C_MN * P_sin_ref) < 1e-4    # P1sin estimates the slope at the zenith
+    assert rel_error(P_sin[1:], C_MN * P_sin_ref[1:]) < 1e-12
+    assert rel_error(P1, C_MN * P1_ref) < 1e-12
+
+
+def test_linear_frequency_interpolation(h5file, delays, amps, sky_points):
+    """With freq_interp='linear' the beam is the weighted sum of the beams of the coefficients of the two
+    tabulated frequencies either side (with the delay phases at the target frequency)"""
+    (az, za) = sky_points
+    AA = beam_full_EE.ApertureArray(h5file, 155e6, freq_interp='linear')
+    assert AA.freq == 155e6
+    assert AA.freq_weights == [(150000000, 0.5), (160000000, 0.5)]
+    jones = beam_full_EE.Beam(AA, delays.copy(), amps.copy()).get_response(az, za)
+
+    expected = 0
+    for (freq, weight) in AA.freq_weights:
+        AA_tab = beam_full_EE.ApertureArray(h5file, freq)
+        AA_tab.freq = 155e6    # phases of the delays at the target frequency
+        expected = expected + weight * beam_full_EE.Beam(AA_tab, delays.copy(), amps.copy()).get_response(az, za)
+    assert rel_error(jones, expected) < 1e-12
+
+    # at a tabulated frequency, the same as the nearest one
+    AA_lin = beam_full_EE.ApertureArray(h5file, 150e6, freq_interp='linear')
+    AA_near = beam_full_EE.ApertureArray(h5file, 150e6)
+    assert np.array_equal(beam_full_EE.Beam(AA_lin, delays.copy(), amps.copy()).get_response(az, za),
+                          beam_full_EE.Beam(AA_near, delays.copy(), amps.copy()).get_response(az, za))
+
+
+def test_single_precision(h5file, delays, amps, sky_points):
+    """Single precision results are complex64, within the bound documented in DirectionBasis"""
+    (az, za) = sky_points
+    beam = beam_full_EE.Beam(beam_full_EE.ApertureArray(h5file, 170e6), delays.copy(), amps.copy())
+    jones = beam.get_response(az, za)
+    jones_single = beam.get_response(az, za, precision='single')
+    assert jones_single.dtype == np.complex64
+    assert rel_error(jones_single, jones) < 1e-6
+
+    gridded = beam.get_gridded_response(2)
+    gridded_single = beam.get_gridded_response(2, precision='single')
+    assert gridded_single.dtype == np.complex64
+    assert rel_error(gridded_single, gridded) < 1e-6
+
+
+def test_chunked_response(h5file, delays, amps, rng):
+    """The chunked evaluation is identical to the direct one, also when written into out"""
+    (az, za) = (rng.uniform(0, 2 * np.pi, (50, 60)), rng.uniform(0, np.pi / 2, (50, 60)))
+    beam = beam_full_EE.Beam(beam_full_EE.ApertureArray(h5file, 170e6), delays.copy(), amps.copy())
+    jones = beam.get_response(az, za)
+    max_memory_bytes = 200 * beam_full_EE.DirectionBasis.get_bytes_per_point(beam.get_nmax())
+    jones_chunked = beam.get_response(az, za, max_memory_bytes=max_memory_bytes)
+    assert jones_chunked.shape == (2, 2, 50, 60)
+    assert rel_error(jones_chunked, jones) < 1e-14
+
+    out = np.empty((2, 2, 50, 60), dtype=np.complex128)
+    assert beam.get_FF_chunked(az, za, max_memory_bytes=max_memory_bytes, out=out) is out
+    assert np.array_equal(out, jones_chunked)
+    with pytest.raises(ValueError):
+        beam.get_FF_chunked(az, za, out=np.empty((2, 2, 5), dtype=np.complex128))
+
+
+def test_threaded_response(h5file, delays, amps, rng):
+    """The chunks evaluated by several threads give the same result as a single thread"""
+    (az, za) = (rng.uniform(0, 2 * np.pi, 3000), rng.uniform(0, np.pi / 2, 3000))
+    beam = beam_full_EE.Beam(beam_full_EE.ApertureArray(h5file, 170e6), delays.copy(), amps.copy())
+    max_memory_bytes = 300 * beam_full_EE.DirectionBasis.get_bytes_per_point(beam.get_nmax())
+    jones_1 = beam.get_response(az, za, max_memory_bytes=max_memory_bytes, n_workers=1)
+    jones_4 = beam.get_response(az, za, max_memory_bytes=max_memory_bytes, n_workers=4)
+    assert np.array_equal(jones_1, jones_4)
+    assert rel_error(jones_4, beam.get_response(az, za)) < 1e-14
+
+
+@pytest.mark.parametrize('pixels_per_deg, phi_start, n_phi', [(1, 0, 361), (5, -50, 300), (0.05, 3, 40)])
+def test_phi_fft(h5file, delays, amps, pixels_per_deg, phi_start, n_phi):
+    """The sum over m with an FFT along a uniform phi axis equals the dense product,
+    also for regions across the azimuth wrap and coarse grids where the m terms alias"""
+    beam = beam_full_EE.Beam(beam_full_EE.ApertureArray(h5file, 170e6), delays.copy(), amps.copy())
+    (Q1, Q2) = beam.get_modes()
+    phi = (phi_start + np.arange(n_phi)) / float(pixels_per_deg) * np.pi / 180
+    theta = np.linspace(0, np.pi / 2, 91)
+    basis_fft = beam_full_EE.DirectionBasis(phi, theta, beam.get_nmax(), grid=True, phi_fft=True)
+    basis_dense = beam_full_EE.DirectionBasis(phi, theta, beam.get_nmax(), grid=True, phi_fft=False)
+    assert basis_fft.fft_len == int(round(360 * pixels_per_deg))
+    assert rel_error(basis_fft.get_jones(Q1, Q2), basis_dense.get_jones(Q1, Q2)) < 1e-13
+
+
+def test_AA_cache_bytes_bound(h5file, monkeypatch):
+    """The gridded beams of all the cached ApertureArray objects stay within one byte budget,
+    and the bytes reported for the ApertureArray objects are those they hold (regression test)"""
+    import beam_cache
+    import config
+    monkeypatch.setattr(config, 'h5file', h5file)
+    monkeypatch.setattr(config, 'coefficient_store', None)
+    grid_nbytes = 2 * 2 * 361 * 91 * 16    # one full grid at 1 pixel per degree
+    monkeypatch.setattr(beam_full_EE, 'AACACHE', beam_cache.LRUCache(max_bytes=10 ** 8, max_entries=8))
+    monkeypatch.setattr(beam_full_EE, 'GRID_CACHE', beam_cache.LRUCache(max_bytes=3 * grid_nbytes))
+
+    freqs = [145e6, 155e6, 165e6, 170e6]
+    for repeat in range(2):
+        for freq in freqs:
+            AA = beam_full_EE.get_AA_Cached(freq, freq_interp='linear')
+            for delay in range(5):
+                gridded = beam_full_EE.Beam(AA, np.full((2, 16), float(delay))).get_gridded_response(1)
+                assert gridded.nbytes == grid_nbytes
+                stats = beam_full_EE.GRID_CACHE.stats()
+                assert stats['bytes'] == stats['entries'] * grid_nbytes <= 3 * grid_nbytes
+
+    stats = beam_full_EE.get_AA_cache_stats()
+    assert stats['entries'] == len(freqs)
+    assert stats['bytes'] == sum([beam_full_EE.get_AA_Cached(freq, freq_interp='linear').get_nbytes()
+                                  for freq in freqs])
+    assert stats['bytes'] > 0    # the interpolated coefficients between tabulated frequencies
+
+
+@pytest.mark.parametrize('nside', [1, 4, 16])
+def test_healpix_response(h5file, delays, amps, nside):
+    """The HEALPix evaluation equals the direct one at the pixel centres, and the pixel weights
+    integrate over the upper hemisphere"""
+    import beam_tools
+    beam = beam_full_EE.Beam(beam_full_EE.ApertureArray(h5file, 150e6), delays.copy(), amps.copy())
+    (az, za, dOMEGA) = beam_tools.makeAZZA_healpix(nside)
+    assert az.shape == (2 * nside * (3 * nside + 1),)
+    assert abs(dOMEGA.sum() - 2 * np.pi) < 1e-12
+
+    jones = beam.get_healpix_response(nside)
+    assert jones.shape == (2, 2) + az.shape
+    assert rel_error(jones, beam.get_response(az, za)) < 1e-13
+
+    # the antenna temperature of a constant sky is that temperature
+    assert np.allclose(beam.get_tant(np.full(12 * nside ** 2, 300.0)), 300.0, rtol=1e-12)
+
+
+def test_beam_set(h5file, rng, sky_points):
+    """A BeamSet gives the same Jones matrices as individual Beams, also in chunks"""
+    (az, za) = sky_points
+    AA = beam_full_EE.ApertureArray(h5file, 150e6)
+    delays = rng.randint(0, 32, (6, 2, 16)).astype(np.float64)
+    delays[2, 1, 4] = 32    # terminated dipole
+    amps = np.ones((6, 2, 16))
+    amps[3, 0, 5] = 0
+    beams = beam_full_EE.BeamSet(AA, delays, amps)
+    expected = np.array([beam_full_EE.Beam(AA, delays[i].copy(), amps[i].copy()).get_response(az, za)
+                         for i in range(len(delays))])
+    jones = beams.get_response(az, za)
+    assert jones.shape == (6, 2, 2) + az.shape
+    assert rel_error(jones, expected) < 1e-13
+    assert rel_error(beams.get_response(az, za, max_memory_bytes=10 ** 5), expected) < 1e-13
+
+
+def test_tile_beams(h5file, delays, sky_points):
+    """TileBeams evaluates each distinct tile configuration once, and each tile's view equals its own Beam"""
+    (az, za) = sky_points
+    AA = beam_full_EE.ApertureArray(h5file, 150e6)
+    n_tiles = 40
+    tile_delays = np.tile(delays, (n_tiles, 1, 1))
+    tile_amps = np.ones((n_tiles, 2, 16))
+    for tile in range(0, n_tiles, 10):
+        tile_amps[tile, 0, tile % 16] = 0    # 4 tiles with a different dead dipole each
+    tile_delays[5, 1, 3] = 32                # 2 tiles with the same terminated dipole
+    tile_delays[25, 1, 3] = 32
+    tiles = beam_full_EE.TileBeams(AA, tile_delays, tile_amps)
+    assert len(tiles.beams) == 6
+
+    views = tiles.get_response(az, za, zenithnorm=True)
+    assert len(views) == n_tiles
+    for tile in [0, 1, 5, 10, 25, 39]:
+        beam = beam_full_EE.Beam(AA, tile_delays[tile].copy(), tile_amps[tile].copy())
+        assert rel_error(views[tile], AA.apply_zenith_norm_Jones(beam.get_response(az, za))) < 1e-13
+
+
+def test_incremental_beam(h5file, delays, amps, sky_points):
+    """Single dipole variants and updates of an IncrementalBeam equal new Beams with those changes"""
+    (az, za) = sky_points
+    AA = beam_full_EE.ApertureArray(h5file, 150e6)
+    incremental = beam_full_EE.IncrementalBeam(AA, az, za, delays, amps)
+    assert rel_error(incremental.jones, beam_full_EE.Beam(AA, delays.copy(), amps.copy()).get_response(az, za)) < 1e-13
+
+    for (pol, ant) in [(0, 0), (1, 7), (0, 15)]:
+        dead_amps = amps.copy()
+        dead_amps[pol, ant] = 0
+        expected = beam_full_EE.Beam(AA, delays.copy(), dead_amps).get_response(az, za)
+        assert rel_error(incremental.get_variant(pol, ant, amp=0), expected) < 1e-13
+
+    incremental.update(1, 3, delay=32)    # terminated
+    incremental.update(0, 5, delay=2, amp=0.7)
+    (new_delays, new_amps) = (delays.copy(), amps.copy())
+    (new_delays[1, 3], new_amps[1, 3]) = (0, 0)
+    (new_delays[0, 5], new_amps[0, 5]) = (2, 0.7)
+    expected = beam_full_EE.Beam(AA, new_delays, new_amps).get_response(az, za)
+    assert rel_error(incremental.jones, expected) < 1e-13
+    assert rel_error(incremental.recalc(), expected) < 1e-13
+
+
+def test_interp_plan(h5file, delays, amps, rng):
+    """Interpolation of the gridded beam with a reusable plan is close to the direct evaluation,
+    closer with cubic interpolation, and NaN below the horizon"""
+    (az, za) = (rng.uniform(0.5, 1.5, 500), rng.uniform(0.2, 1.2, 500))    # a region of the grid
+    beam = beam_full_EE.Beam(beam_full_EE.ApertureArray(h5file, 150e6), delays.copy(), amps.copy())
+    jones = beam.get_response(az, za)
+
+    plan = beam_full_EE.InterpPlan(az, za, pixels_per_deg=5)
+    jones_linear = beam.get_interp_response(None, None, plan=plan)
+    assert np.array_equal(jones_linear, beam.get_interp_response(az, za))
+    plan_cubic = beam_full_EE.InterpPlan(az, za, pixels_per_deg=5, method='cubic')
+    jones_cubic = beam.get_interp_response(None, None, plan=plan_cubic)
+    assert rel_error(jones_linear, jones) < 1e-3
+    assert rel_error(jones_cubic, jones) < 0.1 * rel_error(jones_linear, jones)
+
+    jones_below = beam.get_interp_response(np.array([0.1, 0.2]), np.array([1.5, 1.7]))
+    assert np.isfinite(jones_below[..., 0]).all() and np.isnan(jones_below[..., 1]).all()